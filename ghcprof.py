@@ -0,0 +1,3054 @@
+#!/usr/bin/env python3
+"""
+Parsing and analysis of GHC profiles, independent of Qt; the viewer is
+in ghcprofview.py. Run as a script for headless analysis, see main().
+"""
+
+import sys
+import re
+import argparse
+import io
+import os
+import json
+import mmap
+import struct
+import hashlib
+import logging
+import operator
+import copy
+import weakref
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict
+from itertools import repeat, compress, accumulate
+from concurrent.futures import ProcessPoolExecutor
+from math import nan as NAN, isnan
+
+NAME_COLUMN = 1
+RELATIVE_TIME_COLUMN = 7
+RELATIVE_ALLOC_COLUMN = 8
+
+column_names = ["No", "Name", "Entries",
+                "Time Individual %", "Alloc Individual %",
+                "Time Inherited %", "Alloc Inherited %",
+                "Time Relative %", "Alloc Relative %",
+                "Module", "Source"]
+
+# additional columns of diff trees
+diff_column_names = ["Change", "Entries \u0394",
+                "Time Individual \u0394", "Alloc Individual \u0394",
+                "Time Inherited \u0394", "Alloc Inherited \u0394"]
+
+NO_NODE = -1
+
+log = logging.getLogger(__name__)
+
+# sides of a diff where a node is present
+DIFF_BEFORE = 1
+DIFF_AFTER = 2
+
+# additional column of trees with folded recursion
+recursion_column_names = ["Recursion depth"]
+
+# value of "Change" column by sides of a diff
+CHANGES = {DIFF_BEFORE: "removed", DIFF_AFTER: "added", DIFF_BEFORE | DIFF_AFTER: ""}
+
+class Cancelled(Exception):
+    """
+    Raised by progress callbacks to stop loading of a profile.
+    """
+    pass
+
+class FunctionTable(object):
+    """
+    Table of distinct functions, i.e. (name, module, src) triples.
+    Tree nodes refer to functions by index in this table, so nodes of the
+    same function are told by comparing integers. Trees derived from one
+    profile share the table of that profile.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.modules = []
+        self.srcs = []
+        self._ids = dict()
+        self._strings = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return zip(self.names, self.modules, self.srcs)
+
+    def _string(self, string):
+        # the same module and source names are shared by many functions
+        return self._strings.setdefault(string, string)
+
+    def intern(self, name, module, src):
+        key = (name, module, src)
+        function = self._ids.get(key)
+        if function is None:
+            function = len(self.names)
+            self.names.append(self._string(name))
+            self.modules.append(self._string(module))
+            self.srcs.append(self._string(src))
+            self._ids[key] = function
+        return function
+
+    def find(self, name, module, src):
+        return self._ids.get((name, module, src))
+
+    def copy(self):
+        table = FunctionTable()
+        table.names = list(self.names)
+        table.modules = list(self.modules)
+        table.srcs = list(self.srcs)
+        table._ids = dict(self._ids)
+        table._strings = dict(self._strings)
+        return table
+
+class TreeStore(object):
+    """
+    Columnar storage of a cost-centre tree.
+
+    Every node is identified by its index. Tree structure (parent, first
+    child, next sibling) and numbers are kept in typed arrays, and names
+    are kept once in a FunctionTable, so a node takes a few dozens of bytes
+    instead of a full Python object with its own list and dict.
+    """
+
+    COLUMNS = ("parent", "first_child", "last_child", "next_sibling",
+               "row", "child_count", "function",
+               "no", "entries",
+               "individual_time", "individual_alloc",
+               "inherited_time", "inherited_alloc")
+
+    def __init__(self, functions=None):
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.row = array('i')
+        self.child_count = array('i')
+
+        self.function = array('i')
+
+        self.no = array('i')
+        self.entries = array('q')
+        self.individual_time = array('d')
+        self.individual_alloc = array('d')
+        self.inherited_time = array('d')
+        self.inherited_alloc = array('d')
+
+        if functions is None:
+            functions = FunctionTable()
+        self.functions = functions
+        # aggregated nodes of derived trees: node -> tuple of source numbers
+        self.merged = dict()
+        # children lists of nodes which were accessed by row
+        self._children = dict()
+        self._index = None
+        # LazyTable which loads subtrees of this store on demand, if any
+        self.loader = None
+        # Baseline of a diff tree, see diff_trees
+        self.baseline = None
+        # total ticks and allocated bytes of the profiled run, if known
+        self.total_ticks = None
+        self.total_alloc = None
+        # time and alloc relative to parent, NaN where there is none;
+        # computed in bulk for nodes which were added since last use
+        self.relative_time = array('d')
+        self.relative_alloc = array('d')
+        self._getters = None
+        # greatest number of nested calls folded into each node,
+        # see fold_recursion
+        self.recursion = None
+        # mapped cache file whose read-only views are the columns, if the
+        # store was loaded from the cache (see load_cache); they are
+        # copied into arrays before the store is changed
+        self._mapping = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    def add_node(self, parent, function, no=0, entries=0,
+                 individual_time=0.0, individual_alloc=0.0,
+                 inherited_time=NAN, inherited_alloc=NAN):
+        if self._mapping is not None:
+            self._own_columns()
+        node = len(self.parent)
+        self.parent.append(parent)
+        self.first_child.append(NO_NODE)
+        self.last_child.append(NO_NODE)
+        self.next_sibling.append(NO_NODE)
+        self.child_count.append(0)
+        if parent == NO_NODE:
+            self.row.append(0)
+        else:
+            self.row.append(self.child_count[parent])
+            last = self.last_child[parent]
+            if last == NO_NODE:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[last] = node
+            self.last_child[parent] = node
+            self.child_count[parent] += 1
+            self._children.pop(parent, None)
+        self._index = None
+
+        self.function.append(function)
+
+        self.no.append(no)
+        self.entries.append(entries)
+        self.individual_time.append(individual_time)
+        self.individual_alloc.append(individual_alloc)
+        self.inherited_time.append(inherited_time)
+        self.inherited_alloc.append(inherited_alloc)
+        return node
+
+    def _own_columns(self):
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                owned = array(column.format)
+                owned.frombytes(column.cast('B'))
+                setattr(self, name, owned)
+        self._mapping = None
+
+    def add_parsed(self, parent, has_src, fields):
+        name = fields[0]
+        module = fields[1]
+        src = fields[2]
+        k = 0
+        if has_src and src == "<no":
+            src = "<no>"
+            k = 2
+        elif not has_src:
+            src = "<no>"
+            k = -1
+        return self.add_node(parent, self.functions.intern(name, module, src),
+                    no = int(fields[3+k]),
+                    entries = int(fields[4+k]),
+                    individual_time = float(fields[5+k]),
+                    individual_alloc = float(fields[6+k]),
+                    inherited_time = float(fields[7+k]),
+                    inherited_alloc = float(fields[8+k]))
+
+    def copy_node(self, parent, source, node):
+        function = source.function[node]
+        if source.functions is not self.functions:
+            functions = source.functions
+            function = self.functions.intern(functions.names[function],
+                                             functions.modules[function],
+                                             functions.srcs[function])
+        return self.add_node(parent, function,
+                    no = source.no[node],
+                    entries = source.entries[node],
+                    individual_time = source.individual_time[node],
+                    individual_alloc = source.individual_alloc[node],
+                    inherited_time = source.inherited_time[node],
+                    inherited_alloc = source.inherited_alloc[node])
+
+    def is_aggregate(self, node):
+        """
+        Whether node stands for pruned nodes, see TreePruner. Such nodes
+        are told by negative numbers, copies of them keep the number.
+        """
+        return self.no[node] < 0
+
+    def snapshot(self):
+        """
+        Copy of this store to be sent to a worker process, which this
+        store can't be while it may grow (see LazyTable) and as cached
+        columns are views of a mapped file. The index is shared if it was
+        built; the loader is left out.
+        """
+        store = TreeStore(self.functions.copy())
+        for name in self.COLUMNS:
+            getattr(store, name).frombytes(memoryview(getattr(self, name)).cast('B'))
+        store.merged = dict(self.merged)
+        if self.recursion is not None:
+            store.recursion = array(self.recursion.typecode, self.recursion)
+        store.total_ticks = self.total_ticks
+        store.total_alloc = self.total_alloc
+        if self._index is not None:
+            index = store._index = copy.copy(self._index)
+            index.store = store
+        return store
+
+    def copy_subtree(self, parent, source, node):
+        top = self.copy_node(parent, source, node)
+        stack = [(node, top)]
+        while stack:
+            node, copy = stack.pop()
+            for child in reversed(list(source.iter_children(node))):
+                stack.append((child, self.copy_node(copy, source, child)))
+        return top
+
+    def iter_children(self, node):
+        child = self.first_child[node]
+        while child != NO_NODE:
+            yield child
+            child = self.next_sibling[child]
+
+    def children(self, node):
+        """
+        Children of node, cached for random access by row.
+        """
+        children = self._children.get(node)
+        if children is None:
+            children = array('i', self.iter_children(node))
+            self._children[node] = children
+        return children
+
+    def child(self, node, row):
+        return self.children(node)[row]
+
+    def column_names(self):
+        names = column_names
+        if self.baseline is not None:
+            names = names + diff_column_names
+        if self.recursion is not None:
+            names = names + recursion_column_names
+        return names
+
+    def update_relative(self):
+        """
+        Compute relative time and alloc of nodes added since the last call:
+        the smaller of the values of a node and it's parent, in percents of
+        the larger one. Whole columns are mapped at once; only nodes with
+        values greater than their parent's are visited one by one.
+        """
+        start = len(self.relative_time)
+        parent = self.parent[start:]
+        for inherited, relative in [(self.inherited_time, self.relative_time),
+                                    (self.inherited_alloc, self.relative_alloc)]:
+            values = inherited[start:]
+            # NO_NODE of roots picks NaN from the end
+            ups = list(map((inherited + array('d', [NAN])).__getitem__, parent))
+            # there is no relative value of zero
+            divisors = map({0.0: NAN}.get, ups, ups)
+            percents = list(map(operator.truediv, map(operator.mul, repeat(100.0), values), divisors))
+            for node in compress(range(len(values)), map(operator.gt, values, ups)):
+                percents[node] = 100 * ups[node] / values[node]
+            relative.fromlist(list(map(round, percents, repeat(2))))
+
+    def getters(self):
+        """
+        Functions which return value of each of column_names() for a node,
+        reading the columns directly.
+        """
+        if self._getters is not None:
+            return self._getters
+        names = self.functions.names
+        modules = self.functions.modules
+        srcs = self.functions.srcs
+        function = self.function
+        merged = self.merged
+
+        def no(node):
+            return merged.get(node, self.no[node])
+
+        def relative(values):
+            def get(node):
+                if node >= len(values):
+                    self.update_relative()
+                value = values[node]
+                return None if isnan(value) else value
+            return get
+
+        getters = [no,
+                   lambda node: names[function[node]],
+                   self.entries.__getitem__,
+                   self.individual_time.__getitem__,
+                   self.individual_alloc.__getitem__,
+                   self.inherited_time.__getitem__,
+                   self.inherited_alloc.__getitem__,
+                   relative(self.relative_time),
+                   relative(self.relative_alloc),
+                   lambda node: modules[function[node]],
+                   lambda node: srcs[function[node]]]
+        baseline = self.baseline
+        if baseline is not None:
+            def change(node):
+                return CHANGES[baseline.sides[node]]
+
+            def delta(values, before):
+                return lambda node: values[node] - before[node]
+
+            getters.append(change)
+            for name in ["entries", "individual_time", "individual_alloc", "inherited_time", "inherited_alloc"]:
+                getters.append(delta(getattr(self, name), getattr(baseline, name)))
+        if self.recursion is not None:
+            getters.append(self.recursion.__getitem__)
+        self._getters = getters
+        return getters
+
+    def index(self):
+        """
+        FunctionIndex of this store, built on first use.
+        """
+        if self._index is None:
+            self._index = FunctionIndex(self)
+        return self._index
+
+    def filter(self, root, functions=None, individual_time=None, individual_alloc=None, inherited_time=None, inherited_alloc=None,
+               include_root=False):
+        """
+        Flags of nodes to be shown under root when filtering: a node is
+        shown if it, one of it's ancestors below root or one of it's
+        descendants matches. A node matches if it's function is one of
+        functions (if given) and none of it's values is below the
+        corresponding threshold. Root itself is not shown, unless
+        include_root is set: then it is matched like the other nodes.
+        """
+        nodes = self.index().subtree(root)
+        below = nodes[1:]
+        if not include_root:
+            nodes = below
+        matches = bytearray(len(self))
+        if functions is None:
+            for node in nodes:
+                matches[node] = 1
+        else:
+            good = bytearray(len(self.functions))
+            for function in functions:
+                good[function] = 1
+            function = self.function
+            for node in nodes:
+                matches[node] = good[function[node]]
+        thresholds = [(individual_time, self.individual_time), (individual_alloc, self.individual_alloc),
+                      (inherited_time, self.inherited_time), (inherited_alloc, self.inherited_alloc)]
+        for threshold, values in thresholds:
+            if threshold:
+                for node in nodes:
+                    if threshold > values[node]:
+                        matches[node] = 0
+
+        parent = self.parent
+        # descendants have greater indexes than their ancestors
+        shown = bytearray(matches)
+        for node in reversed(below):
+            if shown[node]:
+                shown[parent[node]] = 1
+        matched_above = bytearray(len(self))
+        for node in nodes:
+            if matches[node] or matched_above[node]:
+                shown[node] = 1
+                for child in self.iter_children(node):
+                    matched_above[child] = 1
+        if not include_root:
+            shown[root] = 0
+        return shown
+
+    def fill_inherited(self):
+        """
+        Calculate inherited time and alloc of nodes where they are not known,
+        e.g. synthetic roots of derived trees.
+        """
+        unknown = bytearray(map(isnan, self.inherited_time))
+        if not any(unknown):
+            return
+        if self._mapping is not None:
+            self._own_columns()
+        for node in compress(range(len(self)), unknown):
+            self.inherited_time[node] = self.individual_time[node]
+            self.inherited_alloc[node] = self.individual_alloc[node]
+        del self.relative_time[:]
+        del self.relative_alloc[:]
+        # children always have greater indexes than their parents
+        for node in reversed(range(len(self))):
+            parent = self.parent[node]
+            if parent != NO_NODE and unknown[parent]:
+                self.inherited_time[parent] += self.inherited_time[node]
+                self.inherited_alloc[parent] += self.inherited_alloc[node]
+
+    def extend_columns(self, other):
+        """
+        Append names and numbers of nodes of other store, which has
+        no tree links yet (see scan_range).
+        """
+        if self._mapping is not None:
+            self._own_columns()
+        functions = array('i', [self.functions.intern(*key) for key in other.functions])
+        self.function.extend(map(functions.__getitem__, other.function))
+        self.no.extend(other.no)
+        self.entries.extend(other.entries)
+        self.individual_time.extend(other.individual_time)
+        self.individual_alloc.extend(other.individual_alloc)
+        self.inherited_time.extend(other.inherited_time)
+        self.inherited_alloc.extend(other.inherited_alloc)
+
+    def nbytes(self):
+        """
+        Approximate memory used by the tree: it's columns, aggregated
+        nodes and index, but not the shared function table.
+        """
+        arrays = [getattr(self, name) for name in self.COLUMNS] + [self.relative_time, self.relative_alloc]
+        size = sum(a.itemsize * len(a) for a in arrays)
+        size += sys.getsizeof(self.merged)
+        for numbers in self.merged.values():
+            size += sys.getsizeof(numbers) + sum(map(sys.getsizeof, numbers))
+        if self._index is not None:
+            size += self._index.nbytes()
+        return size
+
+SEARCH_CONTAINS = 1
+SEARCH_EXACT = 2
+SEARCH_REGEXP = 3
+
+def trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+class FunctionIndex(object):
+    """
+    Index of TreeStore nodes by function, and of functions by name.
+
+    Nodes are grouped by function in one array, in preorder inside each
+    group; preorder numbers of nodes and ends of their subtrees allow to
+    tell if a node is inside of a subtree in constant time. Distinct
+    names are indexed by trigrams for substring search.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        count = len(store)
+
+        # preorder number of each node, and the number following it's subtree
+        self.enter = array('i', [0]) * count
+        self.leave = array('i', [0]) * count
+        order = array('i')
+        number = 0
+        for root in range(count):
+            if store.parent[root] != NO_NODE:
+                continue
+            self.enter[root] = number
+            number += 1
+            order.append(root)
+            stack = [(root, store.iter_children(root))]
+            while stack:
+                node, children = stack[-1]
+                child = next(children, NO_NODE)
+                if child == NO_NODE:
+                    self.leave[node] = number
+                    stack.pop()
+                    continue
+                self.enter[child] = number
+                number += 1
+                order.append(child)
+                stack.append((child, store.iter_children(child)))
+
+        self.order = order
+
+        # nodes grouped by function: nodes of function f are
+        # nodes[offsets[f] : offsets[f+1]]
+        functions = store.function
+        self.nodes = array('i', sorted(order, key=functions.__getitem__))
+        counts = Counter(functions)
+        self.offsets = array('i', accumulate(map(counts.get, range(len(store.functions)), repeat(0)), initial=0))
+
+        self.by_name = dict()
+        for function, name in enumerate(store.functions.names):
+            if name is not None and counts.get(function):
+                self.by_name.setdefault(name, []).append(function)
+        self.names = sorted(self.by_name)
+        self.trigrams = dict()
+        for i, name in enumerate(self.names):
+            for trigram in trigrams(name):
+                self.trigrams.setdefault(trigram, []).append(i)
+
+    def nbytes(self):
+        arrays = [self.enter, self.leave, self.order, self.nodes, self.offsets]
+        size = sum(a.itemsize * len(a) for a in arrays)
+        # names themselves are shared with the function table
+        size += sys.getsizeof(self.names) + sys.getsizeof(self.by_name) + sys.getsizeof(self.trigrams)
+        size += sum(map(sys.getsizeof, self.by_name.values()))
+        size += sum(map(sys.getsizeof, self.trigrams.values()))
+        size += sum(map(sys.getsizeof, self.trigrams))
+        return size
+
+    def nodes_of(self, function):
+        if function + 1 >= len(self.offsets):
+            return self.nodes[0:0]
+        return self.nodes[self.offsets[function] : self.offsets[function+1]]
+
+    def subtree(self, root):
+        """
+        Nodes of subtree of root, root included, in preorder.
+        """
+        return self.order[self.enter[root] : self.leave[root]]
+
+    def is_within(self, node, root):
+        return self.enter[root] <= self.enter[node] < self.leave[root]
+
+    def matching_names(self, text, search_type, within=None):
+        """
+        Sorted names matching the query. A query which refines a previous
+        one may pass it's result as within, to be narrowed instead of
+        searching all names.
+        """
+        if within is not None and search_type == SEARCH_CONTAINS:
+            return [name for name in within if text in name]
+        if search_type == SEARCH_EXACT:
+            if text in self.by_name:
+                return [text]
+            return []
+        elif search_type == SEARCH_CONTAINS:
+            query = trigrams(text)
+            if not query:
+                return [name for name in self.names if text in name]
+            candidates = None
+            for trigram in query:
+                postings = self.trigrams.get(trigram)
+                if not postings:
+                    return []
+                if candidates is None:
+                    candidates = set(postings)
+                else:
+                    candidates.intersection_update(postings)
+            return [self.names[i] for i in sorted(candidates) if text in self.names[i]]
+        else:
+            regexp = re.compile(text)
+            return [name for name in self.names if regexp.match(name)]
+
+    def matching_functions(self, text, search_type):
+        functions = []
+        for name in self.matching_names(text, search_type):
+            functions.extend(self.by_name[name])
+        return functions
+
+    def find(self, functions, root=None):
+        """
+        Nodes of given functions, within subtree of root if specified,
+        in preorder.
+        """
+        nodes = []
+        for function in functions:
+            nodes.extend(self.nodes_of(function))
+        if root is not None:
+            enter = self.enter[root]
+            leave = self.leave[root]
+            nodes = [node for node in nodes if enter <= self.enter[node] < leave]
+        if len(functions) > 1:
+            nodes.sort(key=self.enter.__getitem__)
+        return nodes
+
+    def outermost(self, nodes):
+        """
+        Drop nodes which are inside of subtrees of preceding ones;
+        nodes must be in preorder.
+        """
+        leave = -1
+        for node in nodes:
+            if self.enter[node] >= leave:
+                yield node
+                leave = self.leave[node]
+
+class Record(object):
+    """
+    Lightweight view of one node of a TreeStore.
+    """
+
+    __slots__ = ['store', 'id']
+
+    def __init__(self, store, id):
+        self.store = store
+        self.id = id
+
+    @classmethod
+    def new(cls, store, name = None, module = None, src = None, individual_time = None, parent = None):
+        if parent is None:
+            parent_id = NO_NODE
+        else:
+            parent_id = parent.id
+        id = len(store)
+        if name is None:
+            name = str(id)
+        if individual_time is None:
+            individual_time = 0.0
+        function = store.functions.intern(name, module, src)
+        store.add_node(parent_id, function, no = id, individual_time = individual_time)
+        return Record(store, id)
+
+    @classmethod
+    def copy(cls, other, parent, with_children=False):
+        store = parent.store
+        if with_children:
+            id = store.copy_subtree(parent.id, other.store, other.id)
+        else:
+            id = store.copy_node(parent.id, other.store, other.id)
+        return Record(store, id)
+
+    @property
+    def function(self):
+        return self.store.function[self.id]
+
+    @property
+    def name(self):
+        return self.store.functions.names[self.store.function[self.id]]
+
+    @property
+    def module(self):
+        return self.store.functions.modules[self.store.function[self.id]]
+
+    @property
+    def src(self):
+        return self.store.functions.srcs[self.store.function[self.id]]
+
+    @property
+    def no(self):
+        merged = self.store.merged.get(self.id)
+        if merged is not None:
+            return merged
+        return self.store.no[self.id]
+
+    @property
+    def entries(self):
+        return self.store.entries[self.id]
+
+    @property
+    def individual_time(self):
+        return self.store.individual_time[self.id]
+
+    @property
+    def individual_alloc(self):
+        return self.store.individual_alloc[self.id]
+
+    @property
+    def inherited_time(self):
+        return self.store.inherited_time[self.id]
+
+    @property
+    def inherited_alloc(self):
+        return self.store.inherited_alloc[self.id]
+
+    @property
+    def parent(self):
+        parent = self.store.parent[self.id]
+        if parent == NO_NODE:
+            return None
+        return Record(self.store, parent)
+
+    @property
+    def children(self):
+        store = self.store
+        return [Record(store, child) for child in store.iter_children(self.id)]
+
+    def calls_of(self, needle):
+        """
+        Nodes of needle's function within the tree of this record. An
+        aggregate of pruned nodes stands only for itself.
+        """
+        store = self.store
+        index = store.index()
+        if needle.store is store and store.is_aggregate(needle.id):
+            return [needle.id] if index.is_within(needle.id, self.id) else []
+        function = needle.function_in(store.functions)
+        if function is None:
+            return []
+        return index.find([function], self.id)
+
+    def search(self, needle):
+        return [Record(self.store, node) for node in self.calls_of(needle)]
+
+    def reverse_tree(self, needle, progress=None):
+        """
+        Tree of callers of needle: each call of it (not nested into another
+        one) is merged into the root together with it's chain of callers.
+        progress(done, total) is called with numbers of processed calls.
+        """
+        builder = TreeBuilder(self.store.functions)
+        nodes = list(self.store.index().outermost(self.calls_of(needle)))
+        for i, node in enumerate(nodes):
+            builder.add_callers(builder.root.id, self.store, node, self.id)
+            if progress is not None:
+                progress(i + 1, len(nodes))
+        return builder.finish()
+
+    def forward_tree(self, needle, progress=None):
+        """
+        Tree of callees of needle: subtrees of all it's calls are merged.
+        progress(done, total) is called with numbers of processed calls.
+        """
+        builder = TreeBuilder(self.store.functions)
+        nodes = self.calls_of(needle)
+        for i, node in enumerate(nodes):
+            builder.add_subtree(builder.root.id, self.store, node)
+            if progress is not None:
+                progress(i + 1, len(nodes))
+        return builder.finish()
+
+    def flat_profile(self):
+        """
+        Totals of functions within the tree of this record, as children
+        of a new root, computed in one pass over the subtree in preorder.
+        Inherited values are summed over outermost calls only (the ones
+        with no active call of the same function above them), so that
+        recursive calls are not counted twice.
+        """
+        store = self.store
+        index = store.index()
+        leave = index.leave
+        function_of = store.function
+        count = len(store.functions)
+        entries = array('q', [0]) * count
+        individual_time = array('d', [0.0]) * count
+        individual_alloc = array('d', [0.0]) * count
+        inherited_time = array('d', [0.0]) * count
+        inherited_alloc = array('d', [0.0]) * count
+        # number of calls of each function on the current path
+        active = array('i', [0]) * count
+        # function -> numbers of it's nodes, in order of appearance
+        nos = dict()
+        # (end of subtree, function) of nodes on the current path
+        path = []
+        for node in index.subtree(self.id)[1:]:
+            position = index.enter[node]
+            while path and path[-1][0] <= position:
+                active[path.pop()[1]] -= 1
+            function = function_of[node]
+            entries[function] += store.entries[node]
+            individual_time[function] += store.individual_time[node]
+            individual_alloc[function] += store.individual_alloc[node]
+            if not active[function]:
+                inherited_time[function] += store.inherited_time[node]
+                inherited_alloc[function] += store.inherited_alloc[node]
+            active[function] += 1
+            path.append((leave[node], function))
+            merged = store.merged.get(node)
+            if merged is None:
+                nos.setdefault(function, []).append(store.no[node])
+            else:
+                nos.setdefault(function, []).extend(merged)
+
+        result = TreeStore(store.functions)
+        root = result.add_node(NO_NODE, store.functions.intern("Root", None, None))
+        for function in sorted(nos):
+            node = result.add_node(root, function,
+                        entries = entries[function],
+                        individual_time = individual_time[function],
+                        individual_alloc = individual_alloc[function],
+                        inherited_time = inherited_time[function],
+                        inherited_alloc = inherited_alloc[function])
+            result.merged[node] = tuple(nos[function])
+        result.fill_inherited()
+        return Record(result, root)
+
+    def row(self):
+        if self.store.parent[self.id] == NO_NODE:
+            return 0
+        return self.store.row[self.id]
+
+    @property
+    def relative_time(self):
+        return self.data(RELATIVE_TIME_COLUMN)
+
+    @property
+    def relative_alloc(self):
+        return self.data(RELATIVE_ALLOC_COLUMN)
+
+    @property
+    def change(self):
+        return CHANGES[self.store.baseline.sides[self.id]]
+
+    @property
+    def recursion(self):
+        if self.store.recursion is None:
+            return 1
+        return self.store.recursion[self.id]
+
+    @property
+    def delta_entries(self):
+        return self.entries - self.store.baseline.entries[self.id]
+
+    @property
+    def delta_individual_time(self):
+        return self.individual_time - self.store.baseline.individual_time[self.id]
+
+    @property
+    def delta_individual_alloc(self):
+        return self.individual_alloc - self.store.baseline.individual_alloc[self.id]
+
+    @property
+    def delta_inherited_time(self):
+        return self.inherited_time - self.store.baseline.inherited_time[self.id]
+
+    @property
+    def delta_inherited_alloc(self):
+        return self.inherited_alloc - self.store.baseline.inherited_alloc[self.id]
+
+    def function_in(self, functions):
+        """
+        Id of this record's function in another function table, or None.
+        """
+        if functions is self.store.functions:
+            return self.function
+        return functions.find(self.name, self.module, self.src)
+
+    def is_same_function(self, other):
+        if self.store.functions is other.store.functions:
+            return self.function == other.function
+        return self.name == other.name and \
+                self.module == other.module and \
+                self.src == other.src
+
+    def data(self, col):
+        return self.store.getters()[col](self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and \
+                self.store is other.store and \
+                self.id == other.id
+
+    def __hash__(self):
+        return hash((id(self.store), self.id))
+
+    def __repr__(self):
+        return "[{}] {}: {} ({} children)".format(self.no, self.name, self.individual_time, self.store.child_count[self.id])
+
+class Baseline(object):
+    """
+    Values of the first of compared profiles, by nodes of a diff tree.
+    """
+
+    def __init__(self):
+        self.entries = array('q')
+        self.individual_time = array('d')
+        self.individual_alloc = array('d')
+        self.inherited_time = array('d')
+        self.inherited_alloc = array('d')
+        # DIFF_BEFORE | DIFF_AFTER flags
+        self.sides = bytearray()
+
+    def append(self):
+        self.entries.append(0)
+        self.individual_time.append(0.0)
+        self.individual_alloc.append(0.0)
+        self.inherited_time.append(0.0)
+        self.inherited_alloc.append(0.0)
+        self.sides.append(0)
+
+def add_by_paths(store, index, source, node, parent, values=None,
+                 time_scale=1.0, alloc_scale=1.0, visit=None):
+    """
+    Add subtree of source node under parent in store, by call paths of
+    functions: index maps (parent, function) of store to the node which
+    sums the source nodes of that path. Values are added to values (to
+    store by default), time and alloc multiplied by scales. New nodes are
+    numbered by their ids, so that they are distinct when merging paths
+    of the result, see TreeBuilder. visit(target, created) is called for
+    each node of store before the values of a source node are added.
+    """
+    if values is None:
+        values = store
+    ids = array('i', [store.functions.intern(*key) for key in source.functions])
+    stack = [(node, parent)]
+    while stack:
+        node, parent = stack.pop()
+        key = (parent, ids[source.function[node]])
+        target = index.get(key)
+        created = target is None
+        if created:
+            target = index[key] = store.add_node(parent, key[1], no = len(store),
+                                                 inherited_time = 0.0, inherited_alloc = 0.0)
+        if visit is not None:
+            visit(target, created)
+        values.entries[target] += source.entries[node]
+        values.individual_time[target] += source.individual_time[node] * time_scale
+        values.individual_alloc[target] += source.individual_alloc[node] * alloc_scale
+        values.inherited_time[target] += source.inherited_time[node] * time_scale
+        values.inherited_alloc[target] += source.inherited_alloc[node] * alloc_scale
+        children = list(source.iter_children(node))
+        stack.extend(zip(reversed(children), repeat(target)))
+
+def diff_trees(before, after):
+    """
+    Align trees of two profiles by call paths of functions, i.e. by the
+    identity used by is_same_function. Returns root of a tree which has
+    values of after in the usual columns and values of before in
+    store.baseline; a node missing in one of profiles has zero values
+    for that side.
+    """
+    functions = FunctionTable()
+    store = TreeStore(functions)
+    baseline = store.baseline = Baseline()
+    root = store.add_node(NO_NODE, functions.intern("Root", None, None))
+    baseline.append()
+    baseline.sides[root] = DIFF_BEFORE | DIFF_AFTER
+    # (diff tree parent, function) -> diff tree node
+    index = dict()
+    for side, source, values in [(DIFF_BEFORE, before, baseline), (DIFF_AFTER, after, store)]:
+        def visit(target, created):
+            if created:
+                baseline.append()
+            baseline.sides[target] |= side
+
+        add_by_paths(store, index, source.store, source.id, root, values, visit=visit)
+        total_time = 0.0
+        total_alloc = 0.0
+        for top in store.iter_children(root):
+            total_time += values.inherited_time[top]
+            total_alloc += values.inherited_alloc[top]
+        values.inherited_time[root] = total_time
+        values.inherited_alloc[root] = total_alloc
+    return Record(store, root)
+
+def detach_tree(root):
+    """
+    Returns a function which gives the tree of root, to be called in
+    another thread while the store of root may grow in this one (see
+    LazyTable.fetch and TreePruner.fetch). A lazily loaded table is
+    parsed in whole there; other trees are copied here, as they are.
+    """
+    store = root.store
+    if isinstance(store.loader, LazyTable):
+        loader = store.loader
+        location = loader.locate(root.id)
+        return lambda: loader.parse_whole(NO_NODE, location)
+    copy = TreeStore(FunctionTable())
+    record = Record(copy, copy.copy_subtree(NO_NODE, store, root.id))
+    return lambda: record
+
+class TreeBuilder(object):
+    """
+    Builds a derived tree by merging paths of records of another tree.
+    Records of the same function at the same position are merged into one
+    node; each source record is counted only once per node.
+
+    Children of result nodes are found through one hash map keyed by
+    (parent node, function id), so inserting a path takes time linear in
+    it's length.
+    """
+
+    def __init__(self, functions):
+        self.store = TreeStore(functions)
+        self.root = Record.new(self.store, "Root")
+        self.store.no[self.root.id] = 0
+        # (parent node, function) -> child node
+        self.index = dict()
+        # node -> numbers of source records merged into it
+        self.summands = dict()
+
+    def child(self, node, source, source_node):
+        """
+        Result node for source node under node, created or merged.
+        """
+        store = self.store
+        key = (node, source.function[source_node])
+        no = source.merged.get(source_node, source.no[source_node])
+        if source.is_aggregate(source_node):
+            # pruned nodes of different places have nothing in common
+            key += (no,)
+        child = self.index.get(key)
+        if child is None:
+            child = self.index[key] = store.copy_node(node, source, source_node)
+            self.summands[child] = {no: None}
+        else:
+            summands = self.summands[child]
+            if no in summands:
+                return child
+            summands[no] = None
+            store.entries[child] += source.entries[source_node]
+            store.individual_time[child] += source.individual_time[source_node]
+            store.individual_alloc[child] += source.individual_alloc[source_node]
+            store.inherited_time[child] += source.inherited_time[source_node]
+            store.inherited_alloc[child] += source.inherited_alloc[source_node]
+        return child
+
+    def add_subtree(self, node, source, source_node):
+        """
+        Merge source subtree under node. Source is walked in preorder,
+        which merges nodes in the same order as adding all paths of the
+        subtree one by one.
+        """
+        stack = [(self.child(node, source, source_node), source.iter_children(source_node))]
+        while stack:
+            parent, children = stack[-1]
+            child = next(children, NO_NODE)
+            if child == NO_NODE:
+                stack.pop()
+                continue
+            stack.append((self.child(parent, source, child), source.iter_children(child)))
+
+    def add_callers(self, node, source, source_node, stop):
+        """
+        Merge source node and chain of it's ancestors (up to, but not
+        including stop) under node, in reverse order.
+        """
+        while source_node != stop and source_node != NO_NODE:
+            node = self.child(node, source, source_node)
+            source_node = source.parent[source_node]
+
+    def finish(self):
+        store = self.store
+        for node, summands in self.summands.items():
+            if len(summands) == 1:
+                no = next(iter(summands))
+                if isinstance(no, tuple):
+                    store.merged[node] = no
+                continue
+            nos = []
+            for no in summands:
+                if isinstance(no, tuple):
+                    nos.extend(no)
+                else:
+                    nos.append(no)
+            store.merged[node] = tuple(nos)
+        store.fill_inherited()
+        return self.root
+
+def fold_recursion(root, progress=None):
+    """
+    Copy of the tree of root where recursive calls are folded: a call of
+    a function which is already on the call path is merged, together with
+    it's subtree, into that outer call. Direct and mutual recursion of any
+    depth thus becomes one node. Entries and individual values are summed,
+    inherited values are those of outermost calls. store.recursion holds
+    the greatest number of nested calls folded into each node.
+    """
+    source = root.store
+    functions = source.function
+    store = TreeStore(source.functions)
+    store.total_ticks = source.total_ticks
+    store.total_alloc = source.total_alloc
+    top = store.copy_node(NO_NODE, source, root.id)
+    # (parent node, function) -> child node
+    index = dict()
+    # node -> numbers of source nodes folded into it
+    summands = {top: [source.merged.get(root.id, source.no[root.id])]}
+    recursion = dict()
+    # function -> (node, nesting) of calls on the current path
+    path = {functions[root.id]: (top, 1)}
+    stack = [(child, top, None) for child in reversed(list(source.iter_children(root.id)))]
+    done = 0
+    while stack:
+        node, parent, outer = stack.pop()
+        if node == NO_NODE:
+            # leaving a call of function parent
+            if outer is None:
+                del path[parent]
+            else:
+                path[parent] = outer
+            continue
+        function = functions[node]
+        aggregate = source.is_aggregate(node)
+        outer = None if aggregate else path.get(function)
+        if outer is not None:
+            target, nesting = outer
+            nesting += 1
+            if nesting > recursion.get(target, 1):
+                recursion[target] = nesting
+            copied = False
+        else:
+            nesting = 1
+            key = (parent, function)
+            if aggregate:
+                key += (source.no[node],)
+            target = index.get(key)
+            copied = target is None
+            if copied:
+                target = index[key] = store.copy_node(parent, source, node)
+                summands[target] = []
+            else:
+                # calls at the same place are not nested into each other
+                store.inherited_time[target] += source.inherited_time[node]
+                store.inherited_alloc[target] += source.inherited_alloc[node]
+        if not copied:
+            store.entries[target] += source.entries[node]
+            store.individual_time[target] += source.individual_time[node]
+            store.individual_alloc[target] += source.individual_alloc[node]
+        summands[target].append(source.merged.get(node, source.no[node]))
+        stack.append((NO_NODE, function, outer))
+        path[function] = (target, nesting)
+        stack.extend((child, target, None) for child in reversed(list(source.iter_children(node))))
+        done += 1
+        if progress is not None and done % 4096 == 0:
+            progress(done, len(source))
+
+    for node, nos in summands.items():
+        if len(nos) == 1 and not isinstance(nos[0], tuple):
+            continue
+        merged = []
+        for no in nos:
+            if isinstance(no, tuple):
+                merged.extend(no)
+            else:
+                merged.append(no)
+        store.merged[node] = tuple(merged)
+    store.recursion = array('i', [1]) * len(store)
+    for node, nesting in recursion.items():
+        store.recursion[node] = nesting
+    return Record(store, top)
+
+OTHER_NAME = "(other {} nodes)"
+
+class TreePruner(object):
+    """
+    Copy of a tree where children which are below thresholds of inherited
+    time and alloc are replaced by one node per parent, which carries
+    their summed values and the number of nodes in their subtrees. The
+    copy is the loader of it's store: children of such a node are copied
+    (pruned in the same way) when it is expanded. Aggregates have negative
+    numbers, distinct for each one, see TreeStore.is_aggregate.
+    """
+
+    def __init__(self, source, store, min_time=0.0, min_alloc=0.0, pending=None):
+        self.source = source
+        self.store = store
+        self.min_time = min_time
+        self.min_alloc = min_alloc
+        store.loader = self
+        # aggregated node -> source nodes it replaces
+        self.pending = dict() if pending is None else pending
+
+    def is_significant(self, node):
+        source = self.source
+        return source.inherited_time[node] >= self.min_time and \
+                source.inherited_alloc[node] >= self.min_alloc
+
+    def copy(self, parent, node):
+        """
+        Copy source subtree of node under parent, pruning it.
+        """
+        source = self.source
+        store = self.store
+        index = source.index()
+        top = NO_NODE
+        stack = [(node, parent)]
+        while stack:
+            node, parent = stack.pop()
+            copy = store.copy_node(parent, source, node)
+            if top == NO_NODE:
+                top = copy
+            kept = []
+            rest = []
+            for child in source.iter_children(node):
+                (kept if self.is_significant(child) else rest).append(child)
+            count = sum(index.leave[child] - index.enter[child] for child in rest)
+            if count == 1:
+                # not worth an aggregate
+                kept.extend(rest)
+                rest = []
+            stack.extend((child, copy) for child in reversed(kept))
+            if rest:
+                self.aggregate(copy, rest, count)
+        return top
+
+    def aggregate(self, parent, nodes, count):
+        source = self.source
+        time = sum(map(source.inherited_time.__getitem__, nodes))
+        alloc = sum(map(source.inherited_alloc.__getitem__, nodes))
+        other = self.store.add_node(parent,
+                    self.store.functions.intern(OTHER_NAME.format(count), None, None),
+                    no = -1 - len(self.store),
+                    entries = sum(map(source.entries.__getitem__, nodes)),
+                    individual_time = time, individual_alloc = alloc,
+                    inherited_time = time, inherited_alloc = alloc)
+        self.pending[other] = nodes
+        return other
+
+    def prepare(self, node):
+        """
+        Number of children which fetch(node) will add.
+        """
+        return len(self.pending.get(node, ()))
+
+    def fetch(self, node):
+        """
+        Replace aggregated values of node by copies of nodes it stands for.
+        """
+        nodes = self.pending.pop(node, None)
+        if nodes is None:
+            return
+        store = self.store
+        # values move to the children
+        store.individual_time[node] = 0.0
+        store.individual_alloc[node] = 0.0
+        store.entries[node] = 0
+        for child in nodes:
+            self.copy(node, child)
+
+def prune_tree(root, min_time=0.0, min_alloc=0.0):
+    """
+    Copy of the tree of root with insignificant children aggregated,
+    see TreePruner. Totals stay exact.
+    """
+    store = TreeStore(root.store.functions)
+    store.total_ticks = root.store.total_ticks
+    store.total_alloc = root.store.total_alloc
+    pruner = TreePruner(root.store, store, min_time, min_alloc)
+    return Record(store, pruner.copy(NO_NODE, root.id))
+
+def get_indent(s):
+    count = 0
+    for c in s:
+        if c == ' ':
+            count += 1
+        else:
+            break
+    return count
+
+def parse_table(f, has_src):
+    store = TreeStore()
+    result = []
+    prev_indent = 0
+    prev_node = NO_NODE
+
+    line = f.readline()
+    while line:
+        indent = get_indent(line)
+        fields = line.split()
+        if not fields:
+            line = f.readline()
+            continue
+        if indent > prev_indent:
+            parent = prev_node
+        elif prev_node == NO_NODE:
+            parent = NO_NODE
+        else:
+            parent = store.parent[prev_node]
+            for k in range(prev_indent - indent):
+                if parent == NO_NODE:
+                    break
+                parent = store.parent[parent]
+
+        node = store.add_parsed(parent, has_src, fields)
+        if parent == NO_NODE:
+            result.append(Record(store, node))
+
+        prev_node = node
+        prev_indent = indent
+        line = f.readline()
+
+    return result
+
+TABLE_HEADER_WITH_SRC = [b"COST", b"CENTRE", b"MODULE", b"SRC", b"no.", b"entries", b"%time", b"%alloc", b"%time", b"%alloc"]
+TABLE_HEADER_WITHOUT_SRC = [b"COST", b"CENTRE", b"MODULE", b"no.", b"entries", b"%time", b"%alloc", b"%time", b"%alloc"]
+
+ROW_WITH_SRC = re.compile(rb'^( *)(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)', re.M)
+ROW_WITHOUT_SRC = re.compile(rb'^( *)(\S+)[ \t]+(\S+)[ \t]+(\d+)[ \t]+(\d+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)[ \t]+(\S+)', re.M)
+
+# size of piece of mapped file which is parsed at once
+CHUNK_SIZE = 4 << 20
+
+class FunctionPool(dict):
+    """
+    Maps raw bytes of (name, module, src) to function ids of a TreeStore;
+    each distinct function is decoded only once.
+    """
+    def __init__(self, store):
+        dict.__init__(self)
+        self.functions = store.functions
+
+    def __missing__(self, raw):
+        name, module, src = [part.decode('utf-8', 'replace') for part in raw]
+        function = self[raw] = self.functions.intern(name, module, src)
+        return function
+
+class NumberPool(dict):
+    """
+    Cache of parsed numbers; most of percentages in a profile are
+    the same few values like 0.0.
+    """
+    def __init__(self, convert):
+        dict.__init__(self)
+        self.convert = convert
+
+    def __missing__(self, raw):
+        value = self[raw] = self.convert(raw)
+        return value
+
+PROF_TOTAL_TICKS = re.compile(rb"total time\s*=.*\((\d+) ticks")
+PROF_TOTAL_ALLOC = re.compile(rb"total alloc\s*=\s*([\d,]+) bytes")
+
+def read_totals(store, header):
+    """
+    Set total ticks and bytes of store from header of .prof file.
+    """
+    m = PROF_TOTAL_TICKS.search(header)
+    if m is not None:
+        store.total_ticks = int(m.group(1))
+    m = PROF_TOTAL_ALLOC.search(header)
+    if m is not None:
+        store.total_alloc = int(m.group(1).replace(b",", b""))
+
+def find_table(data):
+    """
+    Find the cost-centre tree table in mapped .prof file.
+    Returns offset of first table row and has_src flag.
+    """
+    pos = data.find(b"COST CENTRE")
+    while pos >= 0:
+        end = data.find(b"\n", pos)
+        if end < 0:
+            end = len(data)
+        fields = data[pos:end].split()
+        if fields == TABLE_HEADER_WITH_SRC:
+            return end + 1, True
+        if fields == TABLE_HEADER_WITHOUT_SRC:
+            return end + 1, False
+        pos = data.find(b"COST CENTRE", end)
+    raise ValueError("Cost centre table not found")
+
+def split_rows(chunk, has_src):
+    """
+    Split piece of the table into indentation levels and columns of fields.
+    """
+    chunk = chunk.replace(b"<no location info>", b"<no>")
+    lines = chunk.split(b"\n")
+    lengths = list(map(len, map(bytes.lstrip, lines)))
+    # blank lines are skipped
+    indents = list(compress(map(operator.sub, map(len, lines), lengths), lengths))
+    n_fields = 9 if has_src else 8
+    tokens = chunk.split()
+    if len(tokens) == n_fields * len(indents):
+        return indents, [tokens[i::n_fields] for i in range(n_fields)]
+
+    # some rows have unusual number of fields; match them one by one
+    row_re = ROW_WITH_SRC if has_src else ROW_WITHOUT_SRC
+    matches = row_re.findall(chunk)
+    if not matches:
+        return [], None
+    columns = list(zip(*matches))
+    return list(map(len, columns[0])), columns[1:]
+
+class TableScanner(object):
+    """
+    Converts pieces of the cost-centre table into columns of a TreeStore.
+    Tree links are not filled; see TreeLinker.
+    """
+
+    def __init__(self, store, has_src):
+        self.store = store
+        self.has_src = has_src
+        self.function = FunctionPool(store).__getitem__
+        self.percent = NumberPool(float).__getitem__
+
+    def scan(self, chunk):
+        """
+        Append rows of chunk to the store, return their indentations.
+        """
+        indents, columns = split_rows(chunk, self.has_src)
+        if not indents:
+            return indents
+
+        store = self.store
+        percent = self.percent
+        k = 0 if self.has_src else -1
+        if self.has_src:
+            srcs = columns[2]
+        else:
+            srcs = repeat(b"<no>")
+        store.function.extend(map(self.function, zip(columns[0], columns[1], srcs)))
+        store.no.extend(map(int, columns[3+k]))
+        store.entries.extend(map(int, columns[4+k]))
+        store.individual_time.extend(map(percent, columns[5+k]))
+        store.individual_alloc.extend(map(percent, columns[6+k]))
+        store.inherited_time.extend(map(percent, columns[7+k]))
+        store.inherited_alloc.extend(map(percent, columns[8+k]))
+        return indents
+
+class TreeLinker(object):
+    """
+    Calculates tree links of TreeStore nodes from indentation of the rows
+    they were parsed from; GHC increases indentation by one per level.
+    Rows can be fed by pieces, in order.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # last node seen at each level; level is indentation + 1,
+        # so that last_at[0] is always NO_NODE
+        self.last_at = [NO_NODE] * 64
+        self.count = len(store.parent)
+
+    def link(self, indents):
+        if not indents:
+            return
+        parents = self.store.parent
+        rows = self.store.row
+        next_sibling = self.store.next_sibling
+        next_sibling.extend(array('i', [NO_NODE]) * len(indents))
+
+        last_at = self.last_at
+        depth = max(indents) + 3
+        if depth > len(last_at):
+            last_at.extend([NO_NODE] * (depth - len(last_at)))
+
+        n = self.count
+        for level in map(operator.add, indents, repeat(1)):
+            parent = last_at[level - 1]
+            prev = last_at[level]
+            # previous node on this level is a sibling if it comes after the parent
+            if prev > parent:
+                next_sibling[prev] = n
+                rows.append(rows[prev] + 1)
+            else:
+                rows.append(0)
+            parents.append(parent)
+            last_at[level] = n
+            last_at[level + 1] = NO_NODE
+            n += 1
+        self.count = n
+
+    def finish(self):
+        """
+        Fill the rest of links, return top-level records.
+        """
+        store = self.store
+        parents = store.parent
+        counts = Counter(parents)
+        nodes = range(self.count)
+        store.child_count.extend(map(counts.get, nodes, repeat(0)))
+        # in preorder, first child of a node immediately follows it
+        store.first_child.extend(map(lambda node, count: node + 1 if count else NO_NODE, nodes, store.child_count))
+        lasts = dict(zip(parents, nodes))
+        store.last_child.extend(map(lasts.get, nodes, repeat(NO_NODE)))
+
+        return [Record(store, node) for node in nodes if parents[node] == NO_NODE]
+
+def iter_chunks(data, pos, end, size=None):
+    """
+    Split data[pos:end] into pieces of about size bytes at line ends.
+    """
+    if size is None:
+        size = CHUNK_SIZE
+    while pos < end:
+        chunk_end = data.find(b"\n", min(pos + size, end), end)
+        if chunk_end < 0:
+            chunk_end = end
+        yield pos, chunk_end
+        pos = chunk_end + 1
+
+def parse_table_bytes(data, pos, has_src, progress=None):
+    """
+    Parse cost-centre table from bytes (or mapped file) starting at pos.
+
+    Each chunk is split into columns at once, columns are converted in bulk,
+    and tree links are calculated from indentation levels.
+    progress(done, total) is called with byte counts after each chunk.
+    """
+    store = TreeStore()
+    scanner = TableScanner(store, has_src)
+    linker = TreeLinker(store)
+    for start, end in iter_chunks(data, pos, len(data)):
+        linker.link(scanner.scan(data[start:end]))
+        if progress is not None:
+            progress(end, len(data))
+    return linker.finish()
+
+def scan_range(path, start, end, has_src):
+    """
+    Scan part of the table in a worker process.
+    Returns store with columns only, and indentations of rows.
+    """
+    store = TreeStore()
+    scanner = TableScanner(store, has_src)
+    indents = array('H')
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for chunk_start, chunk_end in iter_chunks(data, start, end):
+                indents.extend(scanner.scan(data[chunk_start:chunk_end]))
+        finally:
+            data.close()
+    return store, indents
+
+_worker_context = None
+
+def worker_context():
+    """
+    Multiprocessing context of worker processes. They are not forked from
+    this process, whose other threads (e.g. of Qt) may hold locks which a
+    forked child would inherit, but from a server process started afresh,
+    or spawned where there is no such server. The server loads the main
+    module once, rather than each worker.
+    """
+    global _worker_context
+    if _worker_context is None:
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            _worker_context = multiprocessing.get_context('forkserver')
+            _worker_context.set_forkserver_preload(['__main__'])
+        else:
+            _worker_context = multiprocessing.get_context('spawn')
+    return _worker_context
+
+def parse_parallel(path, jobs, progress=None):
+    """
+    Parse .prof file using a pool of jobs processes.
+
+    The table is cut at line ends into pieces which are scanned in workers.
+    Since tree links depend only on the sequence of indentations, they are
+    calculated in this process while pieces arrive in order, so the result
+    is the same as of serial parsing.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos, has_src = find_table(data)
+            header = data[:pos]
+            size = len(data)
+            piece = max(CHUNK_SIZE, (size - pos) // (jobs * 4) + 1)
+            ranges = list(iter_chunks(data, pos, size, piece))
+        finally:
+            data.close()
+
+    if len(ranges) < 2:
+        with open(path, 'rb') as f:
+            return parse_mapped(f, progress)
+
+    store = TreeStore()
+    read_totals(store, header)
+    linker = TreeLinker(store)
+    pool = ProcessPoolExecutor(jobs, mp_context=worker_context())
+    try:
+        parts = pool.map(scan_range, repeat(path), *zip(*ranges), repeat(has_src))
+        for (part, indents), (start, end) in zip(parts, ranges):
+            store.extend_columns(part)
+            linker.link(indents)
+            if progress is not None:
+                progress(end, size)
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+    return linker.finish()
+
+def map_file(f):
+    """
+    Memory mapping of file f, or None if it can't be mapped: f is not a
+    regular file (e.g. a pipe or StringIO) or it is empty.
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+def parse_data(data, progress=None):
+    """
+    Parse mapped .prof file.
+    """
+    pos, has_src = find_table(data)
+    table = parse_table_bytes(data, pos, has_src, progress)
+    if table:
+        read_totals(table[0].store, data[:pos])
+    return table
+
+def parse_mapped(f, progress=None):
+    """
+    Parse .prof file through memory mapping of it's descriptor.
+    """
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return parse_data(data, progress)
+    finally:
+        data.close()
+
+# number of tree levels which are parsed at once in lazy mode
+LAZY_DEPTH = 3
+
+class LazyTable(object):
+    """
+    Cost-centre table of mapped .prof file which is parsed on demand.
+
+    Only rows of LAZY_DEPTH levels are parsed at once. Rows of given levels
+    are found by a regexp, so the rest of the file is only skimmed over.
+    For each node on the last parsed level, the file range of it's subtree
+    is kept in pending until it is fetched. Search, filters and derived
+    views see only loaded nodes.
+    """
+
+    def __init__(self, data, pos, has_src):
+        self.data = data
+        self.has_src = has_src
+        self.store = TreeStore()
+        self.store.loader = self
+        # node -> (start, end) of it's not loaded subtree
+        self.pending = dict()
+        # node and it's child rows found by prepare()
+        self._prepared = [NO_NODE, None]
+        self.roots = self.add_rows(NO_NODE, self.rows(pos, len(data), 0), 0)
+
+    def rows(self, start, end, indent):
+        """
+        Offsets and indentations of rows in data[start:end] which are
+        indented by indent .. indent + LAZY_DEPTH - 1.
+        """
+        # a leading newline lets the regexp engine skip other rows quickly;
+        # start is always preceded by a newline
+        pattern = re.compile(b"\n( {%d,%d})[^ \n]" % (indent, indent + LAZY_DEPTH - 1))
+        return [(m.start(1), len(m.group(1))) for m in pattern.finditer(self.data, start - 1, end)]
+
+    def child_rows(self, node):
+        start, end = self.pending[node]
+        return self.rows(start, end, self.indent(node) + 1)
+
+    def indent(self, node):
+        indent = -1
+        while node != NO_NODE:
+            node = self.store.parent[node]
+            indent += 1
+        return indent
+
+    def add_rows(self, parent, rows, indent):
+        """
+        Parse rows found by rows() under parent, which is indented by
+        indent - 1; returns top-level nodes.
+        """
+        data = self.data
+        store = self.store
+        last = indent + LAZY_DEPTH - 1
+        top = []
+        # nodes of current branch: (indent, node)
+        stack = [(indent - 1, parent)]
+        ends = [offset for offset, _ in rows[1:]]
+        ends.append(self.pending.pop(parent, (0, len(data)))[1])
+        for (offset, level), subtree_end in zip(rows, ends):
+            line_end = data.find(b"\n", offset, subtree_end)
+            if line_end < 0:
+                line_end = subtree_end
+            while stack[-1][0] >= level:
+                stack.pop()
+            fields = data[offset:line_end].decode('utf-8', 'replace').split()
+            node = store.add_parsed(stack[-1][1], self.has_src, fields)
+            stack.append((level, node))
+            if level == indent:
+                top.append(node)
+            # rows below the last level are loaded later
+            if level == last and data[line_end + 1 : line_end + level + 2] == b" " * (level + 1):
+                self.pending[node] = (line_end + 1, subtree_end)
+        return top
+
+    def prepare(self, node):
+        """
+        Number of children which fetch(node) will add; rows found are
+        kept for it.
+        """
+        rows = self._prepared[1] = self.child_rows(node)
+        self._prepared[0] = node
+        indent = self.indent(node) + 1
+        return sum(1 for _, level in rows if level == indent)
+
+    def fetch(self, node):
+        """
+        Load next levels of the subtree of node.
+        """
+        if node in self.pending:
+            rows = self._prepared[1] if self._prepared[0] == node else self.child_rows(node)
+            self._prepared = [NO_NODE, None]
+            self.add_rows(node, rows, self.indent(node) + 1)
+
+    def locate(self, node):
+        """
+        Position of node in the table, for parse_whole: children are
+        loaded in file order, so node is found by it's positions among
+        siblings.
+        """
+        store = self.store
+        path = []
+        while store.parent[node] != NO_NODE:
+            parent = store.parent[node]
+            path.append(list(store.iter_children(parent)).index(node))
+            node = parent
+        path.append(self.roots.index(node))
+        return path
+
+    def parse_whole(self, node, location=None):
+        """
+        Parse the whole table at once, into a new store. Returns record of
+        node there, or of the node at location given by locate; only the
+        mapped file is read then, so this can be called while the store
+        is being loaded in another thread.
+        """
+        if location is None:
+            location = self.locate(node)
+        path = list(location)
+        record = parse_data(self.data)[path.pop()]
+        for position in reversed(path):
+            record = Record(record.store, list(record.store.iter_children(record.id))[position])
+        return record
+
+def parse_lazy(path):
+    """
+    Parse top levels of .prof file; the rest is loaded on demand.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    pos, has_src = find_table(data)
+    table = LazyTable(data, pos, has_src)
+    read_totals(table.store, data[:pos])
+    return [Record(table.store, node) for node in table.roots]
+
+# separators are skipped like whitespace; keys and values are told apart
+# by position in the object
+JSON_TOKEN = re.compile(r"""[\s:,]*(?:
+    # header of GHC's profile node up to start of it's children list
+    (\{\s*"id"\s*:\s*\d+\s*,\s*"entries"\s*:\s*\d+\s*,\s*"alloc"\s*:\s*\d+\s*,\s*"ticks"\s*:\s*\d+\s*,\s*"children"\s*:\s*\[)
+    | ([{}\[\]])
+    | "((?:[^"\\]|\\.)*)"
+    | (-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+    | (true|false|null))""", re.X)
+JSON_NODE_FIELDS = re.compile(r'\d+')
+JSON_LITERALS = {"true": True, "false": False, "null": None}
+
+# size of piece of JSON document which is read at once
+JSON_CHUNK_SIZE = 1 << 20
+
+JSON_NODE = 'n'
+JSON_VALUE = 'v'
+
+def iter_json_tokens(f, progress=None):
+    """
+    Read JSON document from file by pieces, yield (kind, value) tokens.
+    Kind is one of brackets, JSON_VALUE or JSON_NODE; for the latter value
+    is (id, entries, alloc, ticks) of a profile node, whose children list
+    is opened. progress(done, total) is called after each piece with
+    counts of characters, which are bytes for GHC's ASCII output.
+    """
+    total = None
+    if progress is not None:
+        try:
+            total = os.fstat(f.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            pass
+    done = 0
+    buffer = ""
+    pos = 0
+    eof = False
+    while not eof:
+        chunk = f.read(JSON_CHUNK_SIZE)
+        eof = not chunk
+        if progress is not None:
+            done += len(chunk)
+            progress(done, total)
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        size = len(buffer)
+        match = JSON_TOKEN.match
+        while True:
+            m = match(buffer, pos)
+            # token at the end of buffer can continue in the next piece
+            if m is None or (m.end() == size and not eof):
+                break
+            pos = m.end()
+            node, bracket, string, number, literal = m.groups()
+            if node is not None:
+                yield JSON_NODE, tuple(map(int, JSON_NODE_FIELDS.findall(node)))
+            elif bracket is not None:
+                yield bracket, None
+            elif string is not None:
+                if '\\' in string:
+                    string = json.loads('"' + string + '"')
+                yield JSON_VALUE, string
+            elif number is not None:
+                if number.strip("-0123456789"):
+                    yield JSON_VALUE, float(number)
+                else:
+                    yield JSON_VALUE, int(number)
+            else:
+                yield JSON_VALUE, JSON_LITERALS[literal]
+        if eof and buffer[pos:].strip(" \t\r\n:,"):
+            raise ValueError("Invalid JSON near: {}".format(buffer[pos:pos+50]))
+
+class JsonProfileLoader(object):
+    """
+    Builds TreeStore from GHC's JSON profile (+RTS -pj) without loading
+    the whole document. Cost centres are interned into the function
+    table of the store as they come, profile nodes keep only their ids.
+    """
+
+    # roles of JSON containers
+    OTHER = 0
+    TOP = 1
+    COST_CENTRES = 2
+    COST_CENTRE = 3
+    NODE = 4
+    CHILDREN = 5
+
+    def __init__(self):
+        self.store = TreeStore()
+        self.functions = dict()
+        self.total_ticks = None
+        self.total_alloc = None
+        # columns of profile nodes, in preorder
+        self.depths = array('H')
+        self.cost_centres = array('i')
+        self.entries = array('q')
+        self.ticks = array('d')
+        self.alloc = array('d')
+
+    def _start_map(self, role, key):
+        if role is None:
+            return self.TOP, None
+        if role == self.TOP and key == "profile" or role == self.CHILDREN:
+            return self.NODE, self._add_node()
+        if role == self.COST_CENTRES:
+            return self.COST_CENTRE, dict()
+        return self.OTHER, None
+
+    def _start_array(self, role, key):
+        if role == self.TOP and key == "cost_centres":
+            return self.COST_CENTRES
+        if role == self.NODE and key == "children":
+            return self.CHILDREN
+        return self.OTHER
+
+    def _add_node(self, cost_centre=0, entries=0, alloc=0, ticks=0):
+        node = len(self.depths)
+        self.depths.append(len(self._nodes))
+        self.cost_centres.append(cost_centre)
+        self.entries.append(entries)
+        self.alloc.append(alloc)
+        self.ticks.append(ticks)
+        self._nodes.append(node)
+        return node
+
+    def _value(self, role, data, key, value):
+        if role == self.NODE:
+            if key == "id":
+                self.cost_centres[data] = value
+            elif key == "entries":
+                self.entries[data] = value
+            elif key == "ticks":
+                self.ticks[data] = value
+            elif key == "alloc":
+                self.alloc[data] = value
+        elif role == self.COST_CENTRE:
+            data[key] = value
+        elif role == self.TOP:
+            if key == "total_ticks":
+                self.total_ticks = value
+            elif key == "total_alloc":
+                self.total_alloc = value
+
+    def _end_map(self, role, data):
+        if role == self.NODE:
+            self._nodes.pop()
+        elif role == self.COST_CENTRE:
+            store = self.store
+            src = data.get("src_loc", "<no>")
+            if src == "<no location info>":
+                src = "<no>"
+            self.functions[data["id"]] = store.functions.intern(data.get("label"), data.get("module"), src)
+
+    def load(self, f, progress=None):
+        self._nodes = []
+        # stack of [is_map, role, data, current key]
+        stack = []
+        expect_key = False
+        for kind, value in iter_json_tokens(f, progress):
+            if kind == JSON_VALUE:
+                if expect_key:
+                    stack[-1][3] = value
+                    expect_key = False
+                elif stack and stack[-1][0]:
+                    frame = stack[-1]
+                    self._value(frame[1], frame[2], frame[3], value)
+                    expect_key = True
+            elif kind == JSON_NODE:
+                node = self._add_node(*value)
+                stack.append([True, self.NODE, node, "children"])
+                stack.append([False, self.CHILDREN, None, None])
+            elif kind == '{':
+                if stack:
+                    role, key = stack[-1][1], stack[-1][3]
+                else:
+                    role, key = None, None
+                role, data = self._start_map(role, key)
+                stack.append([True, role, data, None])
+                expect_key = True
+            elif kind == '[':
+                role = self._start_array(stack[-1][1], stack[-1][3]) if stack else self.OTHER
+                stack.append([False, role, None, None])
+                expect_key = False
+            else:
+                frame = stack.pop()
+                if frame[0]:
+                    self._end_map(frame[1], frame[2])
+                # after a nested value, the enclosing object continues with a key
+                expect_key = bool(stack) and stack[-1][0]
+
+        return self.finish()
+
+    def finish(self):
+        store = self.store
+        count = len(self.depths)
+        if not count:
+            raise ValueError("No profile tree in JSON document")
+
+        unknown = store.functions.intern("<unknown>", "<unknown>", "<no>")
+        store.function.extend(map(self.functions.get, self.cost_centres, repeat(unknown)))
+        # JSON profile has no cost-centre stack numbers
+        store.no.extend(range(count))
+        store.entries.extend(self.entries)
+
+        total_ticks = self.total_ticks or sum(self.ticks)
+        total_alloc = self.total_alloc or sum(self.alloc)
+        store.individual_time.extend(map(operator.mul, self.ticks, repeat(100.0 / total_ticks if total_ticks else 0.0)))
+        store.individual_alloc.extend(map(operator.mul, self.alloc, repeat(100.0 / total_alloc if total_alloc else 0.0)))
+        store.inherited_time.extend(array('d', [NAN]) * count)
+        store.inherited_alloc.extend(array('d', [NAN]) * count)
+
+        linker = TreeLinker(store)
+        linker.link(self.depths)
+        roots = linker.finish()
+        store.fill_inherited()
+        store.total_ticks = total_ticks
+        store.total_alloc = total_alloc
+        return roots
+
+def is_json_profile(f):
+    """
+    Check if file contains JSON profile; file position is restored.
+    """
+    try:
+        pos = f.tell()
+        start = f.read(64)
+        f.seek(pos)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+    if isinstance(start, bytes):
+        start = start.decode('utf-8', 'replace')
+    return start.lstrip().startswith("{")
+
+def parse_json(f, progress=None):
+    return JsonProfileLoader().load(f, progress)
+
+def parse_file(f, jobs=1, progress=None):
+    """
+    Parse .prof or JSON profile. progress(done, total) is called from
+    time to time with amounts of the file processed, total can be None;
+    it can raise Cancelled to stop parsing. Progress is not reported for
+    pipes.
+    """
+    if is_json_profile(f):
+        return parse_json(f, progress)
+
+    data = map_file(f)
+    if data is not None:
+        try:
+            if jobs > 1:
+                return parse_parallel(f.name, jobs, progress)
+            return parse_data(data, progress)
+        finally:
+            data.close()
+
+    # not a regular file, e.g. a pipe or StringIO
+    header = []
+    line = f.readline()
+    while line:
+        fields = line.split()
+        if fields == ["COST", "CENTRE", "MODULE", "SRC", "no.", "entries", "%time", "%alloc", "%time", "%alloc"]:
+            has_src = True
+            break
+        if fields == ["COST", "CENTRE", "MODULE", "no.", "entries", "%time", "%alloc", "%time", "%alloc"]:
+            has_src = False
+            break
+        header.append(line)
+        line = f.readline()
+    else:
+        raise ValueError("Cost centre table not found")
+    table = parse_table(f, has_src)
+    if table:
+        read_totals(table[0].store, "".join(header).encode('utf-8'))
+    return table
+
+CACHE_SUFFIX = ".ghcpv"
+CACHE_MAGIC = b"GHCPV\0\0\0"
+CACHE_VERSION = 3
+# magic, version, byte order, source size, source mtime, source digest,
+# number of nodes, number of columns
+CACHE_HEADER = struct.Struct("=8sI8sqq32sqq")
+# column name, type code, offset, number of items
+CACHE_COLUMN = struct.Struct("=24s8sqq")
+# size of pieces of the source file which are hashed
+CACHE_SAMPLE_SIZE = 1 << 20
+
+def source_signature(path):
+    """
+    Size, mtime and digest of a profile file. Only the head and the tail
+    of the file are hashed, so that checking the signature of a huge file
+    does not take as long as parsing it.
+    """
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(str(stat.st_size).encode('ascii'))
+    with open(path, 'rb') as f:
+        digest.update(f.read(CACHE_SAMPLE_SIZE))
+        if stat.st_size > 2 * CACHE_SAMPLE_SIZE:
+            f.seek(-CACHE_SAMPLE_SIZE, os.SEEK_END)
+            digest.update(f.read(CACHE_SAMPLE_SIZE))
+    return stat.st_size, stat.st_mtime_ns, digest.digest()
+
+def cache_path(path):
+    return path + CACHE_SUFFIX
+
+def save_cache(path, table):
+    """
+    Write parsed tree to the cache file next to the profile at path.
+    Columns are stored as raw arrays aligned to 8 bytes, so that they
+    can be mapped back without parsing.
+    """
+    store = table[0].store
+    size, mtime, digest = source_signature(path)
+    strings = "\0".join("\0".join(function) for function in store.functions).encode('utf-8')
+    columns = [(name, getattr(store, name)) for name in TreeStore.COLUMNS]
+    columns.append(("roots", array('i', [record.id for record in table])))
+    # -1 for unknown
+    columns.append(("totals", array('q', [-1 if total is None else total
+                                          for total in (store.total_ticks, store.total_alloc)])))
+    columns.append(("strings", array('B', strings)))
+
+    offset = CACHE_HEADER.size + CACHE_COLUMN.size * len(columns)
+    directory = []
+    for name, column in columns:
+        offset = (offset + 7) & ~7
+        directory.append((name, column, offset))
+        offset += len(column) * column.itemsize
+
+    target = cache_path(path)
+    tmp = "{}.{}.tmp".format(target, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, sys.byteorder.encode('ascii'),
+                    size, mtime, digest, len(store), len(columns)))
+        for name, column, offset in directory:
+            f.write(CACHE_COLUMN.pack(name.encode('ascii'), column.typecode.encode('ascii'), offset, len(column)))
+        for name, column, offset in directory:
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(memoryview(column).cast('B'))
+    os.replace(tmp, target)
+
+def load_cache(path):
+    """
+    Map cached tree of the profile at path.
+    Returns None if there is no cache, it is outdated or damaged.
+    """
+    target = cache_path(path)
+    try:
+        f = open(target, 'rb')
+    except OSError:
+        return None
+    with f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+    try:
+        magic, version, byteorder, size, mtime, digest, count, n_columns = \
+                CACHE_HEADER.unpack_from(data, 0)
+    except struct.error:
+        data.close()
+        return None
+    if magic != CACHE_MAGIC or version != CACHE_VERSION or \
+            byteorder.rstrip(b"\0") != sys.byteorder.encode('ascii') or \
+            (size, mtime, digest) != source_signature(path):
+        data.close()
+        return None
+
+    try:
+        columns = read_cache_columns(data, count, n_columns)
+        store = TreeStore()
+        for name in TreeStore.COLUMNS:
+            setattr(store, name, columns[name])
+        strings = bytes(columns["strings"]).decode('utf-8').split("\0")
+        for i in range(0, len(strings) - 2, 3):
+            store.functions.intern(strings[i], strings[i+1], strings[i+2])
+        ticks, alloc = columns["totals"]
+        roots = [Record(store, node) for node in columns["roots"]]
+    except (ValueError, TypeError, struct.error):
+        # damaged cache; the mapping is released with the views of it
+        return None
+    if ticks >= 0:
+        store.total_ticks = ticks
+    if alloc >= 0:
+        store.total_alloc = alloc
+    # columns refer to the mapping, it should live as long as the store
+    store._mapping = data
+    return roots
+
+def read_cache_columns(data, count, n_columns):
+    """
+    Views of columns of mapped cache file by their names. Raises
+    ValueError if the directory does not match the file: a column is
+    missing, has wrong type or length, or lies beyond the end.
+    """
+    if CACHE_HEADER.size + n_columns * CACHE_COLUMN.size > len(data) or n_columns < 0:
+        raise ValueError("Truncated cache directory")
+    view = memoryview(data)
+    columns = dict()
+    for i in range(n_columns):
+        name, typecode, offset, length = CACHE_COLUMN.unpack_from(data, CACHE_HEADER.size + i * CACHE_COLUMN.size)
+        typecode = typecode.rstrip(b"\0").decode('ascii')
+        itemsize = array(typecode).itemsize
+        if offset < 0 or length < 0 or offset % itemsize or offset + length * itemsize > len(data):
+            raise ValueError("Cache column out of the file")
+        columns[name.rstrip(b"\0").decode('ascii')] = \
+                view[offset : offset + length * itemsize].cast(typecode)
+
+    sample = TreeStore()
+    for name in TreeStore.COLUMNS:
+        column = columns.get(name)
+        if column is None or column.format != getattr(sample, name).typecode or len(column) != count:
+            raise ValueError("Bad cache column {}".format(name))
+    for name, length in [("roots", None), ("totals", 2), ("strings", None)]:
+        if name not in columns or (length is not None and len(columns[name]) != length):
+            raise ValueError("Bad cache column {}".format(name))
+    if any(not 0 <= node < count for node in columns["roots"]):
+        raise ValueError("Bad cache column roots")
+    return columns
+
+def load_profile(path, jobs=1, use_cache=True, rebuild_cache=False, lazy=False, progress=None):
+    """
+    Load profile from path, using the cache file next to it when it is
+    up to date, and writing it after parsing otherwise.
+    In lazy mode, only top levels of the tree are parsed and the cache
+    is not written.
+    """
+    if use_cache and not rebuild_cache:
+        table = load_cache(path)
+        if table is not None:
+            return table
+
+    if lazy:
+        return parse_lazy(path)
+
+    with open(path) as f:
+        table = parse_file(f, jobs, progress)
+
+    if use_cache and table:
+        try:
+            save_cache(path, table)
+        except OSError as e:
+            log.warning("Can't write cache %s: %s", cache_path(path), e)
+    return table
+
+def flame_layout(root, key="inherited_time", min_width=0.001):
+    """
+    Layout of flame graph of the tree of root, in fractions of the value of
+    root: list of (x, width, depth, node), parents before children. Children
+    are ordered by value. Nodes narrower than min_width are not descended
+    into; children which are too small to be shown are given one item with
+    node NO_NODE. Only shown nodes are visited, so the cost does not depend
+    on the size of the tree.
+    """
+    store = root.store
+    values = getattr(store, key)
+    total = values[root.id]
+    if not total > 0:
+        return []
+    scale = 1.0 / total
+    result = [(0.0, 1.0, 0, root.id)]
+    stack = [(root.id, 0.0, 0)]
+    while stack:
+        node, x, depth = stack.pop()
+        end = x + values[node] * scale
+        children = [(values[child] * scale, child) for child in store.iter_children(node)
+                        if values[child] > 0]
+        children.sort(reverse=True)
+        shown = 0
+        for width, child in children:
+            # rounding of percents can make children wider than parent
+            width = min(width, end - x)
+            if width < min_width:
+                break
+            result.append((x, width, depth + 1, child))
+            stack.append((child, x, depth + 1))
+            x += width
+            shown += 1
+        rest = min(sum(width for width, _ in children[shown:]), end - x)
+        if rest > 0 and rest >= min_width:
+            result.append((x, rest, depth + 1, NO_NODE))
+    return result
+
+class ProfileMerger(object):
+    """
+    Sums trees of several profiles by call paths of functions. While
+    adding, time and alloc are kept in ticks and bytes, so that each run
+    weighs according to it's totals; finish() converts them back to
+    percents of total ticks and bytes of all runs.
+    """
+
+    def __init__(self):
+        self.store = TreeStore()
+        # (parent, function) -> node; parent is NO_NODE for roots
+        self.index = dict()
+        self.total_ticks = 0
+        self.total_alloc = 0
+
+    def add(self, table):
+        """
+        Add parsed profile. Profiles without totals in the header are
+        counted as runs of 100 ticks and 100 bytes.
+        """
+        store = table[0].store
+        ticks = store.total_ticks if store.total_ticks is not None else 100
+        alloc = store.total_alloc if store.total_alloc is not None else 100
+        self._add(table, ticks / 100.0, alloc / 100.0)
+        self.total_ticks += ticks
+        self.total_alloc += alloc
+
+    def add_partial(self, merger):
+        """
+        Add results of another merger, which was not finished.
+        """
+        roots = [Record(merger.store, node) for (parent, _), node in merger.index.items() if parent == NO_NODE]
+        self._add(roots, 1.0, 1.0)
+        self.total_ticks += merger.total_ticks
+        self.total_alloc += merger.total_alloc
+
+    def _add(self, table, time_scale, alloc_scale):
+        for root in table:
+            add_by_paths(self.store, self.index, root.store, root.id, NO_NODE,
+                         time_scale = time_scale, alloc_scale = alloc_scale)
+
+    def finish(self):
+        """
+        Convert values to percents, return top-level records.
+        """
+        store = self.store
+        time_scale = 100.0 / self.total_ticks if self.total_ticks else 0.0
+        alloc_scale = 100.0 / self.total_alloc if self.total_alloc else 0.0
+        for name, scale in [("individual_time", time_scale), ("inherited_time", time_scale),
+                            ("individual_alloc", alloc_scale), ("inherited_alloc", alloc_scale)]:
+            column = getattr(store, name)
+            setattr(store, name, array('d', map(operator.mul, column, repeat(scale))))
+        store.total_ticks = self.total_ticks
+        store.total_alloc = self.total_alloc
+        return [Record(store, node) for (parent, _), node in self.index.items() if parent == NO_NODE]
+
+def merge_worker(paths, use_cache, rebuild_cache):
+    """
+    Merge a group of profiles in a worker process of merge_profiles.
+    """
+    merger = ProfileMerger()
+    for path in paths:
+        merger.add(load_profile(path, use_cache=use_cache, rebuild_cache=rebuild_cache))
+    return merger
+
+def merge_profiles(paths, jobs=1, use_cache=True, rebuild_cache=False, progress=None):
+    """
+    Parse profiles and merge them into one, see ProfileMerger. With several
+    jobs, groups of profiles are parsed and merged in worker processes,
+    and partial results are merged here.
+    progress(done, total) is called with numbers of merged profiles.
+    """
+    merger = ProfileMerger()
+    if jobs <= 1 or len(paths) < 2:
+        for i, path in enumerate(paths):
+            merger.add(load_profile(path, use_cache=use_cache, rebuild_cache=rebuild_cache))
+            if progress is not None:
+                progress(i + 1, len(paths))
+        return merger.finish()
+
+    groups = [paths[i::jobs] for i in range(min(jobs, len(paths)))]
+    pool = ProcessPoolExecutor(len(groups), mp_context=worker_context())
+    try:
+        done = 0
+        for group, partial in zip(groups, pool.map(merge_worker, groups, repeat(use_cache), repeat(rebuild_cache))):
+            merger.add_partial(partial)
+            done += len(group)
+            if progress is not None:
+                progress(done, len(paths))
+    except BaseException:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+    return merger.finish()
+
+DERIVE_CALLERS = 'callers'
+DERIVE_CALLEES = 'callees'
+DERIVE_FLAT = 'flat'
+DERIVE_FOLD = 'fold'
+DERIVE_PRUNE = 'prune'
+
+def derive(kind, root, record, progress=None, **options):
+    """
+    Derived tree of given kind for record within the tree of root.
+    Options are passed to the transform, e.g. thresholds of prune_tree.
+    Derived trees do not keep the baseline of a comparison, so there are
+    none for diff trees.
+    """
+    if root.store.baseline is not None or record.store.baseline is not None:
+        raise ValueError("Derived trees of a comparison are not supported")
+    if kind == DERIVE_CALLERS:
+        return root.reverse_tree(record, progress)
+    elif kind == DERIVE_CALLEES:
+        return root.forward_tree(record, progress)
+    elif kind == DERIVE_FLAT:
+        return record.flat_profile()
+    elif kind == DERIVE_FOLD:
+        return fold_recursion(record, progress)
+    elif kind == DERIVE_PRUNE:
+        return prune_tree(record, **options)
+    raise ValueError("Unknown kind of derived tree: {}".format(kind))
+
+TASK_PROGRESS = 'progress'
+TASK_DONE = 'done'
+TASK_FAILED = 'failed'
+
+def derive_worker(conn, kind, root, record, options):
+    """
+    Compute derived tree in a worker process, send it through conn.
+    Functions interned in the process are sent along with the columns.
+    """
+    functions = root.store.functions
+    known = len(functions)
+    last = [-1]
+
+    def progress(done, total):
+        # do not flood the pipe with messages
+        value = done * 1000 // total
+        if value != last[0]:
+            last[0] = value
+            conn.send((TASK_PROGRESS, done, total))
+
+    try:
+        result = derive(kind, root, record, progress, **options)
+        store = result.store
+        # aggregated nodes of a pruned tree, to be expanded in the parent
+        pending = None
+        if isinstance(store.loader, TreePruner):
+            pending = store.loader.pending
+        columns = [getattr(store, name) for name in TreeStore.COLUMNS]
+        new_functions = list(functions)[known:]
+        conn.send((TASK_DONE, result.id, columns, store.merged, store.recursion, pending, known, new_functions))
+    except Exception as e:
+        log.exception("Can't compute %s tree", kind)
+        conn.send((TASK_FAILED, str(e)))
+    finally:
+        conn.close()
+
+class DerivedTask(object):
+    """
+    Computation of a derived tree (see derive) in a worker process, so that
+    several of them can run at once and each one can be killed. Snapshots
+    of source stores are sent to the process, only the result is sent
+    back. Without start() the tree is computed in-process by wait().
+    Should be created in the thread which owns the source tree, as the
+    snapshots are taken then.
+    """
+
+    def __init__(self, kind, root, record, **options):
+        self.kind = kind
+        self.root = root
+        self.record = record
+        self.options = options
+        self.process = None
+        self.conn = None
+        # (done, total) of last progress report
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.finished = False
+        # build the index here rather than in the thread running the
+        # task, once for this and next tasks to use
+        root.store.index()
+        snapshots = {root.store: root.store.snapshot()}
+        if record.store not in snapshots:
+            snapshots[record.store] = record.store.snapshot()
+        self._sources = (Record(snapshots[root.store], root.id),
+                         Record(snapshots[record.store], record.id))
+
+    def start(self):
+        context = worker_context()
+        self.conn, child = context.Pipe(duplex=False)
+        self.process = context.Process(target=derive_worker,
+                args=(child, self.kind) + self._sources + (self.options,), daemon=True)
+        self.process.start()
+        child.close()
+        self._sources = None
+
+    def wait(self, timeout=None):
+        """
+        Process messages of the worker for up to timeout seconds.
+        Returns True when the task is finished.
+        """
+        if self.finished:
+            return True
+        if self.process is None:
+            try:
+                self.result = derive(self.kind, self.root, self.record, **self.options)
+            except Exception as e:
+                self.error = str(e)
+            self.finished = True
+            return True
+
+        while self.conn.poll(timeout):
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                self.error = "Worker process died"
+                break
+            if message[0] == TASK_PROGRESS:
+                self.progress = message[1:]
+                timeout = 0
+            elif message[0] == TASK_DONE:
+                self.result = self._receive(*message[1:])
+                break
+            else:
+                self.error = message[1]
+                break
+        else:
+            return False
+        self.finished = True
+        self.conn.close()
+        self.process.join()
+        return True
+
+    def _receive(self, node, columns, merged, recursion, pending, known, new_functions):
+        functions = self.root.store.functions
+        store = TreeStore(functions)
+        for name, column in zip(TreeStore.COLUMNS, columns):
+            setattr(store, name, column)
+        store.merged = merged
+        store.recursion = recursion
+        if pending is not None:
+            TreePruner(self.record.store, store, pending=pending, **self.options)
+        # functions might have been added here since the fork
+        ids = [functions.intern(*key) for key in new_functions]
+        if ids != list(range(known, known + len(ids))):
+            mapping = list(range(known)) + ids
+            store.function = array('i', map(mapping.__getitem__, store.function))
+        return Record(store, node)
+
+    def cancel(self):
+        if self.process is not None and not self.finished:
+            self.process.kill()
+            self.process.join()
+            self.conn.close()
+        self.finished = True
+
+class TreeCache(object):
+    """
+    Least recently used derived trees, within a memory budget in bytes.
+    Trees are keyed by (id of source store, it's size, root node, function,
+    kind); size of the store changes when lazy profile loads more nodes.
+    Keys do not keep stores alive: trees of a store are dropped when it is
+    collected, before it's id can be reused.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._trees = OrderedDict()
+        # id of store -> finalizer which forgets it's trees
+        self._watched = dict()
+
+    def key(self, kind, root, record):
+        if kind in (DERIVE_FLAT, DERIVE_FOLD):
+            # depends on the subtree of record rather than on it's function
+            self._watch(record.store)
+            return (id(record.store), len(record.store), record.id, None, kind)
+        self._watch(root.store)
+        if record.store.is_aggregate(record.id):
+            # an aggregate only stands for itself, see Record.calls_of
+            self._watch(record.store)
+            return (id(root.store), len(root.store), root.id, (id(record.store), record.id), kind)
+        function = record.function_in(root.store.functions)
+        return (id(root.store), len(root.store), root.id, function, kind)
+
+    def _watch(self, store):
+        if id(store) not in self._watched:
+            self._watched[id(store)] = weakref.finalize(store, self._collected, id(store))
+
+    def _collected(self, store_id):
+        del self._watched[store_id]
+        self._forget(store_id)
+
+    def get(self, key):
+        tree = self._trees.get(key)
+        if tree is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._trees.move_to_end(key)
+        tree, size, index = tree
+        if tree.store._index is not index:
+            # the index was built since, it counts too
+            self.size -= size
+            self._add(key, tree)
+        return tree
+
+    def put(self, key, tree):
+        if key not in self._trees:
+            self._add(key, tree)
+
+    def _add(self, key, tree):
+        size = tree.store.nbytes()
+        if size > self.budget:
+            self._trees.pop(key, None)
+            return
+        self._trees[key] = (tree, size, tree.store._index)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, evicted, _) = self._trees.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+
+    def invalidate(self, store):
+        """
+        Forget trees derived from store.
+        """
+        self._forget(id(store))
+
+    def _forget(self, store_id):
+        for key in [key for key in self._trees
+                    if key[0] == store_id or (isinstance(key[3], tuple) and key[3][0] == store_id)]:
+            _, size, _ = self._trees.pop(key)
+            self.size -= size
+
+    def __len__(self):
+        return len(self._trees)
+
+    def __str__(self):
+        return "Cache: {} trees, {:.1f} MB, {} hits, {} misses".format(
+                    len(self), self.size / (1 << 20), self.hits, self.misses)
+
+EXPORT_COLLAPSED = 'collapsed'
+EXPORT_SPEEDSCOPE = 'speedscope'
+
+EXPORT_WEIGHT_TIME = 'time'
+EXPORT_WEIGHT_ALLOC = 'alloc'
+
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+def export_weights(store, weight):
+    """
+    Function which returns exported weight of a node, computed from it's
+    individual value, and the unit of weights. Percents are converted to
+    ticks or bytes when totals of the run are known; nodes must be asked
+    in the order they are exported.
+    """
+    if weight == EXPORT_WEIGHT_TIME:
+        values, total, unit = store.individual_time, store.total_ticks, "none"
+    else:
+        values, total, unit = store.individual_alloc, store.total_alloc, "bytes"
+    if not total:
+        return (lambda node: round(values[node], 6)), "none"
+    scale = total / 100.0
+    # the rounding error is carried over to next nodes, so that the sum
+    # of exported weights is the rounded sum of values
+    exact = [0.0, 0]
+
+    def get(node):
+        exact[0] += values[node] * scale
+        value = int(round(exact[0])) - exact[1]
+        exact[1] += value
+        return value
+    return get, unit
+
+def frame_name(functions, function):
+    name = functions.names[function]
+    module = functions.modules[function]
+    if module:
+        return "{}.{}".format(module, name)
+    return str(name)
+
+# file, line and column of SRC column, e.g. Foo.hs:(12,1)-(20,5) or Foo.hs:12:1-20
+SRC_LOCATION = re.compile(r"^(.+?):\(?(\d+)[,:](\d+)")
+
+def speedscope_frame(functions, function):
+    frame = {"name": frame_name(functions, function)}
+    match = SRC_LOCATION.match(functions.srcs[function] or "")
+    if match:
+        frame.update(file = match.group(1), line = int(match.group(2)), col = int(match.group(3)))
+    return frame
+
+def iter_export(root, weight):
+    """
+    Walk the tree of root in preorder, yielding (depth, node, weight)
+    when a node is entered and (depth, NO_NODE, 0) when it is left.
+    Subtrees without inherited cost are skipped. Only the current path
+    is kept, so memory does not depend on the size of the tree.
+    """
+    store = root.store
+    weights, _ = export_weights(store, weight)
+    inherited = store.inherited_time if weight == EXPORT_WEIGHT_TIME else store.inherited_alloc
+    stack = [store.iter_children(root.id)]
+    yield 0, root.id, weights(root.id)
+    while stack:
+        child = next(stack[-1], NO_NODE)
+        if child == NO_NODE:
+            stack.pop()
+            yield len(stack), NO_NODE, 0
+        elif inherited[child] > 0:
+            yield len(stack), child, weights(child)
+            stack.append(store.iter_children(child))
+
+def export_collapsed(root, out, weight=EXPORT_WEIGHT_TIME):
+    """
+    Write the tree of root as collapsed stacks, one line per node with
+    non-zero weight: frames separated by semicolons, then the weight.
+    """
+    store = root.store
+    path = []
+    for depth, node, value in iter_export(root, weight):
+        if node == NO_NODE:
+            path.pop()
+            continue
+        path.append(frame_name(store.functions, store.function[node]).replace(";", ":"))
+        if value:
+            out.write("{} {}\n".format(";".join(path), value))
+
+def export_speedscope(root, out, weight=EXPORT_WEIGHT_TIME, name=None):
+    """
+    Write the tree of root as an evented speedscope profile: each node
+    is opened, followed by it's children, and closed after it's own
+    weight. Frames are written at the end, once they are all known.
+    """
+    store = root.store
+    _, unit = export_weights(store, weight)
+    if name is None:
+        name = frame_name(store.functions, root.function)
+    # function -> frame index
+    frames = dict()
+    # nodes on the current path, with their functions
+    path = []
+    at = 0
+    out.write('{{"$schema": {}, "exporter": "ghcprofview", "name": {}, "activeProfileIndex": 0,\n'.format(
+            json.dumps(SPEEDSCOPE_SCHEMA), json.dumps(name)))
+    out.write('"profiles": [{{"type": "evented", "name": {}, "unit": "{}", "events": [\n'.format(
+            json.dumps("{} ({})".format(name, weight)), unit))
+    separator = ""
+    for depth, node, value in iter_export(root, weight):
+        if node == NO_NODE:
+            value, frame = path.pop()
+            at += value
+            out.write('{}{{"type": "C", "frame": {}, "at": {}}}'.format(separator, frame, at))
+        else:
+            function = store.function[node]
+            frame = frames.setdefault(function, len(frames))
+            path.append((value, frame))
+            out.write('{}{{"type": "O", "frame": {}, "at": {}}}'.format(separator, frame, at))
+        separator = ",\n"
+    out.write('\n], "startValue": 0, "endValue": {}}}],\n'.format(at))
+    out.write('"shared": {"frames": [\n')
+    separator = ""
+    for function in frames:
+        out.write(separator + json.dumps(speedscope_frame(store.functions, function)))
+        separator = ",\n"
+    out.write('\n]}}\n')
+
+EXPORTERS = {EXPORT_COLLAPSED: export_collapsed, EXPORT_SPEEDSCOPE: export_speedscope}
+
+def export_profile(root, path, fmt, weight=EXPORT_WEIGHT_TIME):
+    """
+    Export the tree of root into file at path in given format. A lazily
+    loaded tree is parsed in whole first, as it's subtrees might not be
+    loaded yet.
+    """
+    if isinstance(root.store.loader, LazyTable):
+        root = root.store.loader.parse_whole(root.id)
+    with open(path, 'w', encoding='utf-8') as out:
+        EXPORTERS[fmt](root, out, weight)
+
+def print_table(table):
+    def print_record(record, indent):
+        print((" " * indent) + str(record))
+        for child in record.children:
+            print_record(child, indent+1)
+
+    for record in table:
+        print_record(record, 0)
+
+# commands of main()
+CLI_COMMANDS = ("top", "callers", "callees", "tree", "diff", "merge", "export")
+
+# values of --by option of top command
+TOP_KEYS = {
+        "individual-time": "individual_time",
+        "individual-alloc": "individual_alloc",
+        "inherited-time": "inherited_time",
+        "inherited-alloc": "inherited_alloc",
+        "entries": "entries",
+    }
+
+def find_function(root, spec):
+    """
+    Find a node of function given by name or Module.name within the tree
+    of root. Raises ValueError if there is no such function or the name
+    is ambiguous.
+    """
+    index = root.store.index()
+    functions = root.store.functions
+    candidates = index.by_name.get(spec, [])
+    if not candidates and "." in spec:
+        module, name = spec.rsplit(".", 1)
+        candidates = [f for f in index.by_name.get(name, []) if functions.modules[f] == module]
+    nodes = index.find(candidates, root.id)
+    if not nodes:
+        raise ValueError("Function not found: {}".format(spec))
+    modules = set(functions.modules[f] for f in candidates)
+    if len(modules) > 1:
+        raise ValueError("Ambiguous function name {}, use one of: {}".format(spec,
+                    ", ".join(sorted("{}.{}".format(m, functions.names[candidates[0]]) for m in modules))))
+    return Record(root.store, nodes[0])
+
+def record_json(record):
+    no = record.no
+    result = dict(name = record.name,
+                module = record.module,
+                src = record.src,
+                no = list(no) if isinstance(no, tuple) else no,
+                entries = record.entries,
+                individual_time = record.individual_time,
+                individual_alloc = record.individual_alloc,
+                inherited_time = record.inherited_time,
+                inherited_alloc = record.inherited_alloc)
+    if record.store.baseline is not None:
+        result.update(change = record.change,
+                delta_entries = record.delta_entries,
+                delta_individual_time = record.delta_individual_time,
+                delta_individual_alloc = record.delta_individual_alloc,
+                delta_inherited_time = record.delta_inherited_time,
+                delta_inherited_alloc = record.delta_inherited_alloc)
+    if record.store.recursion is not None:
+        result.update(recursion = record.recursion)
+    return result
+
+def prune(record, depth, keep=None):
+    """
+    Children of record to be shown in a pruned tree: those for which
+    keep(child) is true, unless depth is exhausted.
+    """
+    if depth == 0:
+        return []
+    return [child for child in record.children if keep is None or keep(child)]
+
+def tree_json(record, depth, keep=None):
+    """
+    Pruned tree of record (see prune) as nested JSON objects. Built
+    without recursion, as trees can be deeper than the recursion limit.
+    """
+    result = record_json(record)
+    stack = [(record, result, depth)]
+    while stack:
+        record, item, depth = stack.pop()
+        item["children"] = children = []
+        for child in prune(record, depth, keep):
+            children.append(record_json(child))
+            stack.append((child, children[-1], depth - 1))
+    return result
+
+def write_tree_json(record, depth, keep=None, out=None):
+    """
+    Write tree_json of record as indented JSON. Nesting is written here,
+    as json.dump recurses once per level of the tree.
+    """
+    if out is None:
+        out = sys.stdout
+    # (record, depth, indent, text before it); closing text has no record
+    stack = [(record, depth, "", "")]
+    while stack:
+        record, depth, indent, before = stack.pop()
+        out.write(before)
+        if record is None:
+            continue
+        # the object without it's closing brace
+        fields = json.dumps(record_json(record), indent=2)[:-2]
+        out.write((fields + ',\n  "children": [').replace("\n", "\n" + indent))
+        children = prune(record, depth, keep)
+        if not children:
+            out.write("]\n" + indent + "}")
+            continue
+        stack.append((None, 0, indent, "\n" + indent + "  ]\n" + indent + "}"))
+        inner = indent + "    "
+        for i in reversed(range(len(children))):
+            stack.append((children[i], depth - 1, inner, ("," if i else "") + "\n" + inner))
+
+TEXT_HEADER = "{:<40} {:<24} {:>10} {:>6} {:>6} {:>6} {:>6}".format(
+        "COST CENTRE", "MODULE", "entries", "%time", "%alloc", "%time", "%alloc")
+DIFF_HEADER = " {:>8} {:>10} {:>7} {:>7} {:>7} {:>7}".format(
+        "change", "entries", "%time", "%alloc", "%time", "%alloc")
+
+def format_record(record, indent=0):
+    name = str(record.name)
+    if record.recursion > 1:
+        name += " (x{})".format(record.recursion)
+    line = "{:<40} {:<24} {:>10} {:>6.1f} {:>6.1f} {:>6.1f} {:>6.1f}".format(
+            " " * indent + name, record.module or "", record.entries,
+            record.individual_time, record.individual_alloc,
+            record.inherited_time, record.inherited_alloc)
+    if record.store.baseline is not None:
+        line += " {:>8} {:>+10} {:>+7.1f} {:>+7.1f} {:>+7.1f} {:>+7.1f}".format(
+            record.change, record.delta_entries,
+            record.delta_individual_time, record.delta_individual_alloc,
+            record.delta_inherited_time, record.delta_inherited_alloc)
+    return line
+
+def print_tree(records, depth, keep=None, out=None):
+    if out is None:
+        out = sys.stdout
+    header = TEXT_HEADER
+    if records and records[0].store.baseline is not None:
+        header += DIFF_HEADER
+    print(header, file=out)
+    stack = [(record, 0) for record in reversed(records)]
+    while stack:
+        record, level = stack.pop()
+        print(format_record(record, level), file=out)
+        children = prune(record, depth - level, keep)
+        stack.extend((child, level + 1) for child in reversed(children))
+
+def main(argv=None):
+    """
+    Headless analysis of a profile: top functions, callers and callees
+    of a function, pruned call tree or differences between two profiles,
+    as text or JSON.
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes used to parse the file")
+    options.add_argument("--no-cache", action='store_true',
+                        help="do not read or write {} cache file".format(CACHE_SUFFIX))
+    options.add_argument("--rebuild-cache", action='store_true',
+                        help="parse the file even if cache is up to date")
+    options.add_argument("--json", action='store_true', help="print JSON instead of text")
+    options.add_argument("--fold-recursion", action='store_true',
+                        help="fold recursive calls into the outermost call of the function")
+    common = argparse.ArgumentParser(add_help=False, parents=[options])
+    common.add_argument("path", help="path to .prof or JSON profile")
+
+    parser = argparse.ArgumentParser(prog="ghcprofview", description="GHC .prof files analysis")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    top = commands.add_parser("top", parents=[common], help="functions with the largest totals")
+    top.add_argument("-n", type=int, default=20, help="number of functions")
+    top.add_argument("--by", choices=sorted(TOP_KEYS), default="individual-time",
+                     help="value to sort by; inherited values of recursive calls are counted once")
+
+    for name, title in [("callers", "tree of callers of a function"),
+                        ("callees", "tree of functions called by a function"),
+                        ("tree", "call tree")]:
+        command = commands.add_parser(name, parents=[common], help=title)
+        if name != "tree":
+            command.add_argument("function", help="function name or Module.name")
+        command.add_argument("--depth", type=int, default=-1 if name != "tree" else 10,
+                             help="maximum depth, -1 for unlimited")
+        command.add_argument("--min-time", type=float, default=0.0 if name != "tree" else 1.0,
+                             help="hide nodes below this inherited time, percent")
+        command.add_argument("--min-alloc", type=float, default=0.0,
+                             help="hide nodes below this inherited alloc, percent")
+        command.add_argument("--group-other", action='store_true',
+                             help="show hidden children of a node as one \"(other N nodes)\" entry")
+
+    merge = commands.add_parser("merge", parents=[options], help="call tree of several profiles merged into one")
+    merge.add_argument("paths", nargs='+', help="paths to profiles")
+    merge.add_argument("--depth", type=int, default=10, help="maximum depth, -1 for unlimited")
+    merge.add_argument("--min-time", type=float, default=1.0,
+                       help="hide nodes below this inherited time, percent")
+    merge.add_argument("--min-alloc", type=float, default=0.0,
+                       help="hide nodes below this inherited alloc, percent")
+    merge.add_argument("--group-other", action='store_true',
+                       help="show hidden children of a node as one \"(other N nodes)\" entry")
+
+    export = commands.add_parser("export", parents=[common], help="call tree in a format of other tools")
+    export.add_argument("--format", choices=sorted(EXPORTERS), default=EXPORT_COLLAPSED,
+                        help="collapsed stacks of flamegraph.pl or speedscope JSON")
+    export.add_argument("--weight", choices=[EXPORT_WEIGHT_TIME, EXPORT_WEIGHT_ALLOC], default=EXPORT_WEIGHT_TIME,
+                        help="individual value to export as the weight of a node")
+    export.add_argument("-o", "--output", help="output file, standard output by default")
+
+    diff = commands.add_parser("diff", parents=[options], help="differences between two profiles")
+    diff.add_argument("before", help="path to the first profile")
+    diff.add_argument("after", help="path to the second profile")
+    diff.add_argument("--depth", type=int, default=-1, help="maximum depth, -1 for unlimited")
+    diff.add_argument("--min-delta", type=float, default=1.0,
+                      help="hide nodes whose inherited time and alloc changed by less than this, percent")
+
+    args = parser.parse_args(argv)
+    if args.command == "merge":
+        paths = []
+    elif args.command == "diff":
+        paths = [args.before, args.after]
+    else:
+        paths = [args.path]
+    roots = []
+    try:
+        for path in paths:
+            table = load_profile(path, args.jobs, use_cache = not args.no_cache,
+                                 rebuild_cache = args.rebuild_cache)
+            if not table:
+                print("No cost centre tree found in {}".format(path), file=sys.stderr)
+                return 1
+            roots.append(table[0])
+        if args.command == "merge":
+            roots = merge_profiles(args.paths, args.jobs, use_cache = not args.no_cache,
+                                   rebuild_cache = args.rebuild_cache)
+    except (OSError, ValueError) as e:
+        print("Can't load {}: {}".format(path if paths else " ".join(args.paths), e), file=sys.stderr)
+        return 1
+    if args.fold_recursion:
+        roots = [fold_recursion(root) for root in roots]
+    root = roots[0]
+
+    if args.command == "export":
+        if args.output is None:
+            EXPORTERS[args.format](root, sys.stdout, args.weight)
+        else:
+            export_profile(root, args.output, args.format, args.weight)
+        return 0
+
+    if args.command == "top":
+        key = operator.attrgetter(TOP_KEYS[args.by])
+        records = sorted(root.flat_profile().children, key=key, reverse=True)[:args.n]
+        if args.json:
+            result = []
+            for record in records:
+                item = record_json(record)
+                item["calls"] = len(item.pop("no"))
+                result.append(item)
+            json.dump(result, sys.stdout, indent=2)
+            print()
+        else:
+            print_tree(records, 0)
+        return 0
+
+    if args.command == "diff":
+        tree = diff_trees(roots[0], roots[1])
+        # nodes which changed or have changed descendants; time can move
+        # between children without changing inherited time of the parent
+        store = tree.store
+        changed = bytearray(len(store))
+        for node in reversed(range(len(store))):
+            record = Record(store, node)
+            if changed[node] or abs(record.delta_inherited_time) >= args.min_delta or \
+                    abs(record.delta_inherited_alloc) >= args.min_delta:
+                changed[node] = 1
+                if store.parent[node] != NO_NODE:
+                    changed[store.parent[node]] = 1
+        keep = lambda record: changed[record.id]
+    else:
+        min_time = args.min_time
+        min_alloc = args.min_alloc
+        keep = lambda record: record.inherited_time >= min_time and record.inherited_alloc >= min_alloc
+        if args.command in ("tree", "merge"):
+            tree = root
+        else:
+            try:
+                needle = find_function(root, args.function)
+            except ValueError as e:
+                print(e, file=sys.stderr)
+                return 1
+            if args.command == "callers":
+                tree = root.reverse_tree(needle)
+            else:
+                tree = root.forward_tree(needle)
+        if args.group_other:
+            tree = prune_tree(tree, min_time, min_alloc)
+            keep = None
+
+    depth = args.depth if args.depth >= 0 else sys.maxsize
+    if args.json:
+        write_tree_json(tree, depth, keep)
+        print()
+    else:
+        print_tree([tree], depth, keep)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,429 +1,35 @@
 #!/usr/bin/env python3
 
 import sys
+
+import ghcprof
+
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in ghcprof.CLI_COMMANDS:
+    # headless analysis does not need Qt
+    sys.exit(ghcprof.main(sys.argv[1:]))
+
 import re
+import argparse
 import traceback
+import os
+import threading
+import weakref
 
-from PyQt5.QtGui import QPainter, QPixmap, QIcon, QStandardItemModel, QStandardItem, QColor
+from PyQt5.QtGui import QPainter, QPixmap, QIcon, QStandardItemModel, QStandardItem, QColor, QKeySequence
 from PyQt5 import QtCore
-from PyQt5.QtCore import QRect, QSize, Qt, QObject, QTimer, pyqtSignal, QSettings, QModelIndex, QVariant, QAbstractItemModel, QSortFilterProxyModel, QItemSelectionModel
+from PyQt5.QtCore import QRect, QSize, Qt, QObject, QTimer, pyqtSignal, QSettings, QModelIndex, QVariant, QAbstractItemModel, QSortFilterProxyModel, QItemSelectionModel, QThread
 from PyQt5.QtWidgets import QApplication, QWidget, QToolBar, QMainWindow, \
         QDialog, QVBoxLayout, QHBoxLayout, QAction, QActionGroup, QLabel, QFileDialog, \
         QFrame, QDockWidget, QMessageBox, QListWidget, QListWidgetItem, QMenu, \
         QSpinBox, QComboBox, \
         QTreeView, QLineEdit, QPushButton, QAbstractItemView, QStyle, \
-        QStyledItemDelegate, QTabWidget
-
-NAME_COLUMN = 1
-
-column_names = ["No", "Name", "Entries",
-                "Time Individual %", "Alloc Individual %",
-                "Time Inherited %", "Alloc Inherited %",
-                "Time Relative %", "Alloc Relative %",
-                "Module", "Source"]
-
-class Record(object):
-    def __init__(self, id):
-        self.id = id
-        self._row = 0
-        self.children = []
-        self.summands = dict()
-        self.parent = None
-
-        self.no = 0
-        self.entries = 0
-        self.individual_time = 0
-        self.individual_alloc = 0
-
-        self._relative_time = None
-        self._relative_alloc = None
-        self._inherited_time = None
-        self._inherited_alloc = None
-
-    @classmethod
-    def parse(cls, id, has_src, fields):
-        record = Record(id)
-
-        record.name = fields[0]
-        record.module = fields[1]
-        record.src = fields[2]
-        k = 0
-        if has_src and record.src == "<no":
-            record.src = "<no>"
-            k = 2
-        elif not has_src:
-            record.src = "<no>"
-            k = -1
-        record.no = int(fields[3+k])
-        record.entries = int(fields[4+k])
-        record.individual_time = float(fields[5+k])
-        record.individual_alloc = float(fields[6+k])
-        record._inherited_time = float(fields[7+k])
-        record._inherited_alloc = float(fields[8+k])
-
-        return record
-
-    @classmethod
-    def new(cls, id, name = None, module = None, src = None, individual_time = None):
-        record = Record(id)
-        record.no = id
-        if name is None:
-            name = id
-        record.name = name
-        record.module = module
-        record.src = src
-        if individual_time is not None:
-            record.individual_time = individual_time
-        return record
-
-    @classmethod
-    def copy(cls, other, with_children=False):
-        record = Record(other.id)
-        record.name = other.name
-        record.module = other.module
-        record.src = other.src
-        record.no = other.no
-        record.entries = other.entries
-        record.individual_time = other.individual_time
-        record.individual_alloc = other.individual_alloc
-        record._inherited_time = other._inherited_time
-        record._inherited_alloc = other._inherited_alloc
-        if with_children:
-            for child in other.children:
-                record.add_child(Record.copy(child, with_children))
-        return record
-
-    def has_child_no(self, no):
-        return no in [child.no for child in self.children]
-
-    def add_child(self, child):
-        child._row = len(self.children)
-        child.parent = self
-        self.children.append(child)
-
-    def add_children(self, children):
-        for child in children:
-            self.add_child(child)
-
-    def is_sum(self):
-        return self.no == [] or len(self.summands) != 0
-
-    def add(self, other):
-        next_id = self.get_max_id([other]) + 1
-        result = Record.new(next_id, self.name, self.module, self.src)
-
-        if self.is_sum():
-            result.summands = other.summands.copy()
-            #print("add (self): {} + {}".format(result.summands, self.summands))
-            result.summands.update(self.summands)
-        else:
-            result.summands[self.no] = self
-
-        if other.is_sum():
-            result.summands.update(self.summands.copy())
-            #print("add (other): {} + {}".format(result.summands, other.summands))
-            result.summands.update(other.summands)
-        else:
-            if other.no not in result.summands:
-                result.summands[other.no] = other
-
-        result.no = tuple(result.summands.keys())
-
-        if len(result.no) == 1 and len(result.summands) == 1:
-            return result.summands[result.no[0]]
-
-        children = self.children + other.children
-        new_children = []
-        for child in children:
-            new_child = None
-            for existing_child in new_children:
-                if existing_child.is_same_function(child):
-                    new_child = existing_child.add(child)
-                    break
-
-            if new_child is None:
-                new_child = child
-            new_children.append(new_child)
-
-        result.add_children(new_children)
-
-        return result
-
-    def _flatten(self):
-        if not self.is_sum():
-            return [self.no], self
-
-        self.individual_time = 0
-        self.individual_alloc = 0
-        self._inherited_time = 0
-        self._inherited_alloc = 0
-        self.entries = 0
-        #self.children = []
-
-        nos = []
-        for no in self.summands:
-            n, that = self.summands[no]._flatten()
-            self.entries += that.entries
-            self.individual_time += that.individual_time
-            self.individual_alloc += that.individual_alloc
-            self._inherited_time += that.inherited_time
-            self._inherited_alloc += that.inherited_alloc
-            #self.add_children(that.children)
-            nos.extend(n)
-        nos = tuple(nos)
-
-        if len(nos) == 1:
-            self.no = nos[0]
-        else:
-            self.no = nos
-
-        self.summands = dict()
-
-        return self.no, self
-
-    def flatten(self):
-        for child in self.children:
-            child.flatten()
-        self._flatten()
-
-    def get_max_id(self, items=None):
-        result = self.id
-        for child in self.children:
-            m = child.get_max_id()
-            if m > result:
-                result = m
-        if items is not None:
-            for item in items:
-                m = item.get_max_id()
-                if m > result:
-                    result = m
-        return result
-
-    @staticmethod
-    def insert(root, path):
-        def go(root, path, depth):
-            if not path:
-                return
-            head = path[0]
-            rest = path[1:]
-            next_child = None
-            new_children = []
-            for i, child in enumerate(root.children[:]):
-                if child.is_same_function(head):
-                    new_child = child.add(head)
-                    new_children.append(new_child)
-                    next_child = new_child
-                else:
-                    new_children.append(child)
-
-            assert len(new_children) == len(root.children)
-            for i, child in enumerate(new_children):
-                child._row = i
-                child.parent = root
-            root.children = new_children
-
-            if next_child is None:
-                root.add_child(head)
-                next_child = head
-
-            go(next_child, rest, depth+1)
-
-        go(root, path, 0)
-
-    def get_all_paths(self):
-        me = Record.copy(self)
-        paths = []
-        if not self.children:
-            return [[me]]
-        for child in self.children:
-            for child_path in child.get_all_paths():
-                paths.append([me] + child_path)
-        return paths
-
-    def search_paths(self, needle, with_children=False):
-        if self.is_same_function(needle):
-            copy = Record.copy(self, with_children)
-            return [[copy]]
-        paths = []
-        for child in self.children:
-            for sub_path in child.search_paths(needle, with_children):
-                copy = Record.copy(self, with_children)
-                paths.append([copy] + sub_path)
-        return paths
-
-    def search(self, needle):
-        results = []
-        if self.is_same_function(needle):
-            results.append(self)
-        for child in self.children:
-            sub_results = child.search(needle)
-            results.extend(sub_results)
-        return results
-
-    def reverse_tree(self, needle):
-        root = Record.new(self.get_max_id()+1, "Root")
-        for path in self.search_paths(needle):
-            Record.insert(root, list(reversed(path[1:])))
-        root.flatten()
-        #print_table([root])
-        return root
-
-    def forward_tree(self, needle):
-        root = Record.new(self.get_max_id()+1, "Root")
-        for item in self.search(needle):
-            for sub_path in item.get_all_paths():
-                Record.insert(root, sub_path)
-        root.flatten()
-        #print_table([root])
-        return root
-
-    def row(self):
-        if not self.parent:
-            return 0
+        QStyledItemDelegate, QTabWidget, QProgressBar, QScrollArea
 
-        return self._row
-        #return self.parent.children.index(self)
-
-    @property
-    def inherited_time(self):
-        if self._inherited_time is None:
-            value = self.individual_time
-            for child in self.children:
-                value += child.inherited_time
-            self._inherited_time = value
-        return self._inherited_time
-
-    @property
-    def inherited_alloc(self):
-        if self._inherited_alloc is None:
-            value = self.individual_alloc
-            for child in self.children:
-                value += child.inherited_alloc
-            self._inherited_alloc = value
-        return self._inherited_alloc
-
-    def _calc_percent(self, parent, value):
-        if parent is None:
-            return None
-        if value > parent:
-            value, parent = parent, value
-        if parent == 0:
-            return None
-
-        return round(100 * value / parent, 2)
-
-    @property
-    def relative_time(self):
-        if self._relative_time is None:
-            self._relative_time = self._calc_percent(self.parent.inherited_time, self.inherited_time)
-        return self._relative_time
-
-    @property
-    def relative_alloc(self):
-        if self._relative_alloc is None:
-            self._relative_alloc = self._calc_percent(self.parent.inherited_alloc, self.inherited_alloc)
-        return self._relative_alloc
-
-    def is_same_function(self, other):
-        return self.name == other.name and \
-                self.module == other.module and \
-                self.src == other.src
-
-    def data(self, col):
-        row = [self.no,
-                self.name,
-                self.entries,
-                self.individual_time,
-                self.individual_alloc,
-                self.inherited_time,
-                self.inherited_alloc,
-                self.relative_time,
-                self.relative_alloc,
-                self.module,
-                self.src
-            ]
-        return row[col]
-
-    def __eq__(self, other):
-        return  self.id == other.id and \
-                self.no == other.no and \
-                self.name == other.name and \
-                self.module == other.module and \
-                self.src == other.src and \
-                self.entries == other.entries
-
-    def __repr__(self):
-        return "[{}] {}: {} ({} children)".format(self.no, self.name, self.individual_time, len(self.children))
-
-def get_indent(s):
-    count = 0
-    for c in s:
-        if c == ' ':
-            count += 1
-        else:
-            break
-    return count
-
-def parse_table(f, has_src):
-    result = []
-    prev_indent = 0
-    prev_record = None
-
-    line = f.readline()
-    n = 0
-    while line:
-        indent = get_indent(line)
-        fields = line.split()
-        if not fields:
-            line = f.readline()
-            continue
-        #print(n, indent, fields[0])
-        record = Record.parse(n, has_src, fields)
-        if indent > prev_indent:
-            prev_record.add_child(record)
-            record.parent = prev_record
-        else:
-            if not prev_record:
-                result.append(record)
-            else:
-                parent = prev_record.parent
-                for k in range(prev_indent - indent):
-                    parent = parent.parent
-
-                if parent:
-                    parent.add_child(record)
-                    record.parent = parent
-                else:
-                    result.append(record)
-
-        prev_record = record
-        prev_indent = indent
-        line = f.readline()
-        n += 1
-
-    return result
-
-def parse_file(f):
-    line = f.readline()
-    while line:
-        fields = line.split()
-        if fields == ["COST", "CENTRE", "MODULE", "SRC", "no.", "entries", "%time", "%alloc", "%time", "%alloc"]:
-            has_src = True
-            break
-        if fields == ["COST", "CENTRE", "MODULE", "no.", "entries", "%time", "%alloc", "%time", "%alloc"]:
-            has_src = False
-            break
-        line = f.readline()
-    return parse_table(f, has_src)
-
-def print_table(table):
-    def print_record(record, indent):
-        print((" " * indent) + str(record))
-        for child in record.children:
-            print_record(child, indent+1)
-
-    for record in table:
-        print_record(record, 0)
+from ghcprof import NAME_COLUMN, NO_NODE, Cancelled, Record, \
+        SEARCH_CONTAINS, SEARCH_EXACT, SEARCH_REGEXP, CACHE_SUFFIX, load_profile, \
+        DERIVE_CALLERS, DERIVE_CALLEES, DERIVE_FLAT, DERIVE_FOLD, DERIVE_PRUNE, DerivedTask, TreeCache, \
+        diff_trees, detach_tree, merge_profiles, flame_layout, fold_recursion, export_profile, \
+        EXPORT_COLLAPSED, EXPORT_SPEEDSCOPE, EXPORT_WEIGHT_TIME, EXPORT_WEIGHT_ALLOC
 
 def percent_color(value):
     zero = QColor.fromHsv(111, 100, 190)
@@ -434,9 +40,9 @@ def percent_color(value):
     if value >= 1:
         return one
 
-    return QColor((1 - value) * zero.red() + value * one.red(),
-                  (1 - value) * zero.green() + value * one.green(),
-                  (1 - value) * zero.blue() + value * one.blue())
+    return QColor(int((1 - value) * zero.red() + value * one.red()),
+                  int((1 - value) * zero.green() + value * one.green()),
+                  int((1 - value) * zero.blue() + value * one.blue()))
 
 class PercentDelegate(QStyledItemDelegate):
     def paint(self, painter, option, index):
@@ -456,7 +62,7 @@ class PercentDelegate(QStyledItemDelegate):
             percent = 0
         if percent > 100:
             percent = 100
-        w = option.rect.width() * percent / 100
+        w = int(option.rect.width() * percent / 100)
         color = percent_color(percent / 100)
         painter.fillRect(option.rect.x(), option.rect.y(), w, option.rect.height(), color)
         painter.drawText(option.rect, 0, str(value) + " %")
@@ -466,49 +72,145 @@ class PercentDelegate(QStyledItemDelegate):
 #         pass
 
 class DataModel(QAbstractItemModel):
-    def __init__(self, record):
+    """
+    Tree of record, which is shown as the only top-level row if show_root
+    is set; otherwise it's children are top-level rows. Several models
+    can show parts of one store: nodes are never copied or moved, and
+    each model maps rows and parents by itself.
+    """
+
+    # models of each store, to be notified when it's loader adds nodes
+    sharing = weakref.WeakKeyDictionary()
+
+    def __init__(self, record, show_root=False):
         QAbstractItemModel.__init__(self)
         self.record = record
+        self.store = record.store
+        self.show_root = show_root
+        self.columns = self.store.column_names()
+        # cells are read from the store columns, see TreeStore.getters
+        self.getters = self.store.getters()
+        # Qt does not keep references to internal pointers,
+        # so views of nodes shown in the tree are kept here
+        self._items = dict()
+        DataModel.sharing.setdefault(self.store, weakref.WeakSet()).add(self)
+
+    def _item(self, node):
+        item = self._items.get(node)
+        if item is None:
+            item = self._items[node] = Record(self.store, node)
+        return item
+
+    def _row(self, node):
+        if node == self.record.id:
+            return 0
+        return self.store.row[node]
+
+    def shows(self, node):
+        """
+        Whether node is within the tree of this model.
+        """
+        root = self.record.id
+        parent = self.store.parent
+        while node != NO_NODE:
+            if node == root:
+                return True
+            node = parent[node]
+        return False
 
     def index(self, row, column, parent):
         if not self.hasIndex(row, column, parent):
             return QModelIndex()
 
         if not parent.isValid():
-            parentItem = self.record
+            if self.show_root:
+                return self.createIndex(0, column, self._item(self.record.id))
+            parent_node = self.record.id
         else:
-            parentItem = parent.internalPointer()
+            parent_node = parent.internalPointer().id
 
-        if row < len(parentItem.children):
-            childItem = parentItem.children[row]
-            return self.createIndex(row, column, childItem)
+        if row < self.store.child_count[parent_node]:
+            child = self.store.child(parent_node, row)
+            return self.createIndex(row, column, self._item(child))
         else:
             return QModelIndex()
 
+    def index_for(self, node, column=0):
+        if node == self.record.id and not self.show_root:
+            return QModelIndex()
+        return self.createIndex(self._row(node), column, self._item(node))
+
     def parent(self, index):
         if not index.isValid():
             return QModelIndex()
 
-        childItem = index.internalPointer()
-        parentItem = childItem.parent
-        if not parentItem:
-            #print("{}: no parent".format(childItem))
+        node = index.internalPointer().id
+        if node == self.record.id:
+            return QModelIndex()
+        parent_node = self.store.parent[node]
+        if parent_node == NO_NODE:
             return QModelIndex()
-        return self.createIndex(parentItem.row(), 0, parentItem)
+        return self.index_for(parent_node)
 
     def columnCount(self, parent):
-        return len(column_names)
+        return len(self.columns)
 
     def rowCount(self, parent):
         if parent.column() > 0:
             return 0
 
         if not parent.isValid():
-            parentItem = self.record
+            if self.show_root:
+                return 1
+            node = self.record.id
+        else:
+            node = parent.internalPointer().id
+
+        return self.store.child_count[node]
+
+    def hasChildren(self, parent):
+        if parent.column() > 0:
+            return False
+
+        if not parent.isValid():
+            if self.show_root:
+                return True
+            node = self.record.id
         else:
-            parentItem = parent.internalPointer()
+            node = parent.internalPointer().id
 
-        return len(parentItem.children)
+        if self.store.child_count[node]:
+            return True
+        loader = self.store.loader
+        return loader is not None and node in loader.pending
+
+    def canFetchMore(self, parent):
+        loader = self.store.loader
+        if loader is None or not parent.isValid():
+            return False
+        return parent.internalPointer().id in loader.pending
+
+    def fetchMore(self, parent):
+        loader = self.store.loader
+        if loader is None or not parent.isValid():
+            return
+        node = parent.internalPointer().id
+        if node not in loader.pending:
+            return
+        count = loader.prepare(node)
+        if count:
+            # other tabs may show the same node
+            models = [model for model in DataModel.sharing[self.store] if model.shows(node)]
+            first = self.store.child_count[node]
+            for model in models:
+                model.beginInsertRows(model.index_for(node), first, first + count - 1)
+            loader.fetch(node)
+            for model in models:
+                model.endInsertRows()
+                # values of aggregated nodes move to their children
+                model.dataChanged.emit(model.index_for(node), model.index_for(node, len(model.columns) - 1))
+        else:
+            loader.pending.pop(node)
 
 #     def sort(self, column, order):
 #         key = lambda r : r.data(column)
@@ -522,9 +224,9 @@ class DataModel(QAbstractItemModel):
         #print("data({}, {}) = {}".format(index.row(), index.column(), item))
 
         if role == QtCore.Qt.UserRole:
-            return item.data(index.column())
+            return self.getters[index.column()](item.id)
         elif role == QtCore.Qt.DisplayRole:
-            value = item.data(index.column())
+            value = self.getters[index.column()](item.id)
             if isinstance(value, float):
                 value = round(value, 2)
             if not isinstance(value, (int, float, str)) and value is not None:
@@ -539,9 +241,9 @@ class DataModel(QAbstractItemModel):
 
     def headerData(self, section, orientation, role):
         if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
-            if section < 0 or section >= len(column_names):
+            if section < 0 or section >= len(self.columns):
                 return QVariant()
-            return column_names[section]
+            return self.columns[section]
         else:
             return QVariant()
 
@@ -549,129 +251,37 @@ class FilterModel(QSortFilterProxyModel):
     def __init__(self, parent):
         QSortFilterProxyModel.__init__(self, parent)
         self.tab = parent
-        self.individual_time = None
-        self.individual_alloc = None
-        self.inherited_time = None
-        self.inherited_alloc = None
-        self.name = None
-
-    def check(self, sourceRow, sourceParent):
-        idx = self.sourceModel().index(sourceRow, NAME_COLUMN, sourceParent)
-        if not idx.isValid():
-            return False
-        record = self.sourceModel().data(idx, QtCore.Qt.UserRole + 1)
-
-        if self.individual_time is not None and self.individual_time > record.individual_time:
-            return False
-
-        if self.individual_alloc is not None and self.individual_alloc > record.individual_alloc:
-            return False
-
-        if self.inherited_time is not None and self.inherited_time > record.inherited_time:
-            return False
-
-        if self.inherited_alloc is not None and self.inherited_alloc > record.inherited_alloc:
-            return False
-
-        def good(name):
-            search_type = self.tab.search_type.currentData()
-            if search_type == SEARCH_EXACT:
-                return self.name == name
-            elif search_type == SEARCH_CONTAINS:
-                return self.name in name
-            else:
-                if self.regexp:
-                    return self.regexp.match(name) is not None
-                else:
-                    return True
-
-        if self.name and not good(record.name):
-        #if self.name and self.name not in record.name:
-            return False
-
-        return True
-    
-    def check_name(self, search_type, needle, name):
-        if search_type == SEARCH_EXACT:
-            return needle == name
-        elif search_type == SEARCH_CONTAINS:
-            return needle in name
-        else:
-            return re.compile(needle).match(name) is not None
+        # flags of source nodes accepted by the filter, None if not filtering
+        self.shown = None
 
     def filterAcceptsRow(self, sourceRow, sourceParent):
-        if self.check(sourceRow, sourceParent):
+        if self.shown is None:
             return True
-
-        parent = sourceParent
-        while parent and parent.isValid():
-            if self.check(parent.row(), parent.parent()):
-                return True
-            parent = parent.parent()
-
-        if self.hasAcceptedChildren(sourceRow, sourceParent):
-            return True
-
-        return False
-
-    def hasAcceptedChildren(self, sourceRow, sourceParent):
-        item = self.sourceModel().index(sourceRow, NAME_COLUMN, sourceParent)
-        if not item.isValid():
-            return False
-
-        childCount = item.model().rowCount(item)
-        for row in range(childCount):
-            if self.check(row, item):
-                return True
-            if self.hasAcceptedChildren(row, item):
-                return True
-        return False
-
-    def setFilter(self, name, individual_time, individual_alloc, inherited_time, inherited_alloc):
-        self.name = name
+        model = self.sourceModel()
+        if sourceParent.isValid():
+            parent = sourceParent.internalPointer().id
+        elif model.show_root:
+            return self.shown[model.record.id] == 1
+        else:
+            parent = model.record.id
+        node = model.store.child(parent, sourceRow)
+        # nodes loaded after filtering are shown
+        return node >= len(self.shown) or self.shown[node] == 1
+
+    def setFilter(self, name, individual_time, individual_alloc, inherited_time, inherited_alloc, search_type=SEARCH_CONTAINS):
+        model = self.sourceModel()
+        functions = None
         if name:
-            self.regexp = re.compile(name)
-        self.inherited_time = inherited_time
-        self.inherited_alloc = inherited_alloc
-        self.individual_time = individual_time
-        self.individual_alloc = individual_alloc
+            functions = model.store.index().matching_functions(name, search_type)
+        self.shown = model.store.filter(model.record.id, functions,
+                individual_time, individual_alloc, inherited_time, inherited_alloc,
+                include_root=model.show_root)
         self.invalidateFilter()
 
     def reset(self):
-        self.name = None
-        self.regexp = None
-        self.inherited_time = None
-        self.inherited_alloc = None
-        self.individual_time = None
-        self.individual_alloc = None
+        self.shown = None
         self.invalidateFilter()
 
-    def search(self, start, value, search_type):
-        result = []
-        p = self.parent(start)
-        row_from = start.row()
-        row_to = self.rowCount(p)
-
-        for i in range(2):
-            for r in range(row_from, row_to):
-                idx = self.index(r, NAME_COLUMN, p)
-                if not idx.isValid():
-                    continue
-                v = self.data(idx, QtCore.Qt.DisplayRole)
-                if self.check_name(search_type, value, v):
-                    result.append(idx)
-
-                tree_idx = self.index(r, 0, p)
-                if self.hasChildren(tree_idx):
-                    sub_start = self.index(0, 0, tree_idx)
-                    sub = self.search(sub_start, value, search_type)
-                    result.extend(sub)
-
-            row_from = 0
-            row_to = start.row()
-
-        return result
-
 def make_header_menu(tree):
     def toggle(i):
         def trigger():
@@ -680,7 +290,9 @@ def make_header_menu(tree):
         return trigger
 
     menu = QMenu(tree)
-    for i, title in enumerate(column_names):
+    model = tree.model()
+    for i in range(model.columnCount(QModelIndex())):
+        title = model.headerData(i, QtCore.Qt.Horizontal, QtCore.Qt.DisplayRole)
         action = menu.addAction(title)
         action.setCheckable(True)
         action.setChecked(not tree.isColumnHidden(i))
@@ -688,19 +300,70 @@ def make_header_menu(tree):
 
     return menu
 
-SEARCH_CONTAINS = 1
-SEARCH_EXACT = 2
-SEARCH_REGEXP = 3
+# milliseconds since the last key press before searching
+SEARCH_DELAY = 300
+# names whose nodes are found at once
+SEARCH_BATCH = 256
+
+class SearchThread(QThread):
+    """
+    Finds nodes of functions matching a query within the subtree of root
+    node, in batches of names, so that first results can be shown while
+    the rest is being searched. Names matched by previous query of the
+    same index are narrowed down if the query refines it. The index is
+    built by the caller: the store may grow in the GUI thread meanwhile.
+    """
+
+    found = pyqtSignal(object)
+    # (index, names) when the search is complete
+    matched = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, index, root, text, search_type, previous, include_root, parent):
+        QThread.__init__(self, parent)
+        self.index = index
+        self.root = root
+        self.text = text
+        self.search_type = search_type
+        # (index, text, search type, names) of previous query
+        self.previous = previous
+        self.include_root = include_root
+
+    def run(self):
+        index = self.index
+        within = None
+        if self.previous is not None:
+            previous_index, text, search_type, names = self.previous
+            if previous_index is index and search_type == self.search_type == SEARCH_CONTAINS and text in self.text:
+                within = names
+        try:
+            names = index.matching_names(self.text, self.search_type, within)
+        except re.error as e:
+            self.failed.emit("Invalid regular expression: {}".format(e))
+            return
+        root = self.root
+        for start in range(0, len(names), SEARCH_BATCH):
+            if self.isInterruptionRequested():
+                return
+            functions = []
+            for name in names[start : start + SEARCH_BATCH]:
+                functions.extend(index.by_name[name])
+            nodes = [node for node in index.find(functions, root) if node != root or self.include_root]
+            if nodes:
+                self.found.emit(nodes)
+        self.matched.emit((index, names))
 
 class TreeView(QWidget):
-    def __init__(self, table, parent):
+    def __init__(self, table, parent, source=None, show_root=False):
         QWidget.__init__(self, parent)
         self.window = parent
+        # root of the tree this one was derived from, if any
+        self.source = source
         self.tree = QTreeView(self)
         indent = self.tree.indentation()
-        self.tree.setIndentation(indent / 2)
+        self.tree.setIndentation(indent // 2)
 
-        self.model = DataModel(table)
+        self.model = DataModel(table, show_root)
         self.sorter = sorter = FilterModel(self)
         sorter.setSourceModel(self.model)
         self.tree.setModel(sorter)
@@ -732,6 +395,14 @@ class TreeView(QWidget):
         btn = QPushButton("&Search", self)
         searchbox.addWidget(btn)
         btn.clicked.connect(self._on_search)
+        # search as you type, once typing pauses
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(SEARCH_DELAY)
+        self._search_timer.timeout.connect(self._on_search)
+        self.search.textChanged.connect(lambda: self._search_timer.start())
+        self.search.returnPressed.connect(self._on_search)
+        self.search_type.currentIndexChanged.connect(lambda: self._search_timer.start())
 
         btn = QPushButton("&Next", self)
         searchbox.addWidget(btn)
@@ -777,6 +448,10 @@ class TreeView(QWidget):
         btn = QPushButton("&Reset", self)
         filterbox.addWidget(btn)
         btn.clicked.connect(self._on_reset_filter)
+        btn = QPushButton("&Prune", self)
+        btn.setToolTip("Open a tab where nodes below inherited thresholds are grouped")
+        filterbox.addWidget(btn)
+        btn.clicked.connect(self._on_prune)
 
         vbox = QVBoxLayout()
         vbox.addLayout(searchbox)
@@ -786,6 +461,8 @@ class TreeView(QWidget):
 
         self._search_idxs = None
         self._search_idx_no = 0
+        self._searcher = None
+        self._last_query = None
 
     def _expand_to(self, idx):
         idxs = [idx]
@@ -800,53 +477,134 @@ class TreeView(QWidget):
             self.tree.expand(idx)
 
     def _on_search(self):
+        """
+        Start searching in background; results are shown as they come.
+        """
+        self._search_timer.stop()
+        self.stop_search()
         text = self.search.text()
-        selected = self.tree.selectedIndexes()
-#         if selected:
-#             start = selected[0]
-#         else:
-        start = self.sorter.index(0,NAME_COLUMN)
         search_type = self.search_type.currentData()
-        if search_type == SEARCH_EXACT:
-            method = QtCore.Qt.MatchFixedString 
-        elif search_type == SEARCH_CONTAINS:
-            method = QtCore.Qt.MatchContains
-        else:
-            method = QtCore.Qt.MatchRegExp
-
-        self._search_idxs = idxs = self.sorter.search(start, text, search_type)
-        if idxs:
-            self.window.statusBar().showMessage("Found: {} occurence(s)".format(len(idxs)))
-            self._search_idx_no = 0
-            idx = idxs[0]
-            self._locate(idx)
+        self._search_idxs = []
+        if not text:
+            self.window.statusBar().clearMessage()
+            return
+        root = self.model.record
+        thread = SearchThread(root.store.index(), root.id, text, search_type, self._last_query, self.model.show_root, self)
+        thread.found.connect(lambda nodes: self._on_found(thread, nodes))
+        thread.matched.connect(lambda result: self._on_matched(thread, text, search_type, result))
+        thread.failed.connect(lambda message: self._on_search_failed(thread, message))
+        thread.finished.connect(thread.deleteLater)
+        self._searcher = thread
+        self.window.statusBar().showMessage("Searching...")
+        thread.start()
+
+    def stop_search(self):
+        if self._searcher is not None:
+            self._searcher.requestInterruption()
+            self._searcher = None
+
+    def _on_found(self, thread, nodes):
+        if thread is not self._searcher:
+            return
+        first = not self._search_idxs
+        self._search_idxs.extend(nodes)
+        self.window.statusBar().showMessage("Searching: {} occurence(s) so far".format(len(self._search_idxs)))
+        if first:
+            self._search_idx_no = -1
+            self._locate_next()
+
+    def _on_matched(self, thread, text, search_type, result):
+        if thread is not self._searcher:
+            return
+        self._searcher = None
+        index, names = result
+        self._last_query = (index, text, search_type, names)
+        nodes = self._search_idxs
+        if not nodes:
+            self.window.statusBar().showMessage("Not found")
+            return
+        # batches come by names, occurences are visited in tree order
+        current = nodes[self._search_idx_no]
+        nodes.sort(key=index.enter.__getitem__)
+        self._search_idx_no = nodes.index(current)
+        self.window.statusBar().showMessage("Found: {} occurence(s)".format(len(nodes)))
+
+    def _on_search_failed(self, thread, message):
+        if thread is not self._searcher:
+            return
+        self._searcher = None
+        self.window.statusBar().showMessage(message)
+
+    def show_occurrences(self, record):
+        """
+        Search for calls of record's function, which may come from
+        another tree.
+        """
+        root = self.model.record
+        function = record.function_in(root.store.functions)
+        nodes = []
+        if function is not None:
+            nodes = [node for node in root.store.index().find([function], root.id) if node != root.id or self.model.show_root]
+        self._show_found(nodes)
+
+    def _show_found(self, nodes):
+        self._search_idxs = nodes
+        if nodes:
+            self.window.statusBar().showMessage("Found: {} occurence(s)".format(len(nodes)))
+            self._search_idx_no = -1
+            self._locate_next()
         else:
             self.window.statusBar().showMessage("Not found")
 
-    def _locate(self, idx):
+    def _locate(self, node):
+        idx = self.sorter.mapFromSource(self.model.index_for(node, NAME_COLUMN))
+        if not idx.isValid():
+            # hidden by the filter
+            return False
         self.tree.resizeColumnToContents(0)
         self.tree.resizeColumnToContents(NAME_COLUMN)
         self._expand_to(idx)
         self.tree.setCurrentIndex(idx)
-        #self.tree.selectionModel().select(idx, QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Current | QItemSelectionModel.Rows)
-        #self.tree.scrollTo(idx, QAbstractItemView.PositionAtCenter)
+        return True
+
+    def _locate_next(self):
+        # skip occurences which are hidden by the filter
+        n = len(self._search_idxs)
+        for i in range(n):
+            self._search_idx_no = (self._search_idx_no + 1) % n
+            if self._locate(self._search_idxs[self._search_idx_no]):
+                return True
+        return False
 
     def _on_search_next(self):
         if self._search_idxs:
             n = len(self._search_idxs)
-            self._search_idx_no = (self._search_idx_no + 1) % n
-            idx = self._search_idxs[self._search_idx_no]
+            self._locate_next()
             self.window.statusBar().showMessage("Occurence {} of {}".format(self._search_idx_no, n))
-            self._locate(idx)
         else:
             self.window.statusBar().showMessage("No search results")
 
     def _on_filter(self):
-        self.sorter.setFilter(self.search.text(), self.individual_time.value(), self.individual_alloc.value(), self.inherited_time.value(), self.inherited_alloc.value())
+        try:
+            self.sorter.setFilter(self.search.text(), self.individual_time.value(), self.individual_alloc.value(),
+                    self.inherited_time.value(), self.inherited_alloc.value(), self.search_type.currentData())
+        except re.error as e:
+            self.window.statusBar().showMessage("Invalid regular expression: {}".format(e))
 
     def _on_reset_filter(self):
         self.sorter.reset()
 
+    def _on_prune(self):
+        min_time = self.inherited_time.value()
+        min_alloc = self.inherited_alloc.value()
+        if not min_time and not min_alloc:
+            self.window.statusBar().showMessage("Set inherited time or alloc threshold to prune")
+            return
+        root = self.model.record
+        title = "Pruned below {}% time, {}% alloc".format(min_time, min_alloc)
+        self.window.derive(DERIVE_PRUNE, root, root, title,
+                min_time = float(min_time), min_alloc = float(min_alloc))
+
     def _on_header_menu(self, pos):
         menu = make_header_menu(self.tree)
         menu.exec_(self.mapToGlobal(pos))
@@ -858,66 +616,703 @@ class TreeView(QWidget):
             record = self.sorter.data(index, QtCore.Qt.UserRole + 1)
             #print("okay?..")
             #print("context: {}".format(record))
-            menu = self.window.make_item_menu(self.model, record)
+            menu = self.window.make_item_menu(self.model, record, self)
             menu.exec_(self.tree.viewport().mapToGlobal(pos))
 
+FLAME_ROW_HEIGHT = 18
+FLAME_KEYS = [("Time", "inherited_time"), ("Alloc", "inherited_alloc")]
+
+class FlameGraph(QWidget):
+    """
+    Icicle-style flame graph: root on top, widths proportional to
+    inherited time or alloc. The layout is computed for the current
+    width only down to one pixel (see flame_layout), and cached until
+    other tabs load more nodes of the tree.
+    """
+
+    hovered = pyqtSignal(str)
+
+    def __init__(self, root, parent):
+        QWidget.__init__(self, parent)
+        self.root = root
+        self.key = FLAME_KEYS[0][1]
+        # functions to highlight
+        self.highlight = frozenset()
+        self.setMouseTracking(True)
+        self._items = None
+        self._items_key = None
+        self._colors = dict()
+        # notified when nodes are loaded under root, see DataModel.fetchMore
+        self.model = DataModel(root)
+        self._changed = QTimer(self)
+        self._changed.setSingleShot(True)
+        self._changed.setInterval(0)
+        self._changed.timeout.connect(self._on_changed)
+        self.model.rowsInserted.connect(lambda: self._changed.start())
+        self.model.dataChanged.connect(lambda: self._changed.start())
+        self._update_height()
+
+    def items(self):
+        """
+        Layout of the graph for the current width, see flame_layout.
+        """
+        width = max(1, self.width())
+        key = (self.root.id, self.key, width)
+        if self._items_key != key:
+            self._items = flame_layout(self.root, self.key, 1.0 / width)
+            self._items_key = key
+        return self._items
+
+    def _on_changed(self):
+        self._items_key = None
+        self._update_height()
+
+    def _update_height(self):
+        depth = max((item[2] for item in self.items()), default=0)
+        self.setMinimumHeight((depth + 1) * FLAME_ROW_HEIGHT)
+        self.update()
+
+    def set_key(self, key):
+        self.key = key
+        self._update_height()
+
+    def set_highlight(self, functions):
+        self.highlight = frozenset(functions)
+        self.update()
+
+    def zoom(self, record):
+        self.root = record
+        self._update_height()
+
+    def _color(self, function):
+        color = self._colors.get(function)
+        if color is None:
+            name = self.root.store.functions.names[function] or ""
+            # stable warm colors
+            hue = sum(map(ord, name)) * 7 % 50
+            color = self._colors[function] = QColor.fromHsv(hue, 150 + len(name) * 13 % 80, 235)
+        return color
+
+    def item_at(self, pos):
+        width = self.width()
+        depth = pos.y() // FLAME_ROW_HEIGHT
+        x = pos.x() / width
+        for left, size, level, node in self.items():
+            if level == depth and left <= x < left + size:
+                return node
+        return None
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        width = self.width()
+        clip = event.rect()
+        store = self.root.store
+        function = store.function
+        names = store.functions.names
+        metrics = painter.fontMetrics()
+        highlight = QColor.fromHsv(210, 160, 240)
+        other = QColor.fromHsv(0, 0, 200)
+        for left, size, depth, node in self.items():
+            y = depth * FLAME_ROW_HEIGHT
+            if y > clip.bottom() or y + FLAME_ROW_HEIGHT < clip.top():
+                continue
+            rect = QRect(int(left * width), y, max(1, int(size * width) - 1), FLAME_ROW_HEIGHT - 1)
+            if node == NO_NODE:
+                painter.fillRect(rect, other)
+                continue
+            f = function[node]
+            painter.fillRect(rect, highlight if f in self.highlight else self._color(f))
+            if rect.width() > 20:
+                text = metrics.elidedText(names[f] or "", Qt.ElideRight, rect.width() - 4)
+                painter.drawText(rect.adjusted(2, 0, -2, 0), Qt.AlignVCenter | Qt.AlignLeft, text)
+
+    def mouseMoveEvent(self, event):
+        node = self.item_at(event.pos())
+        if node is None:
+            self.hovered.emit("")
+        elif node == NO_NODE:
+            self.hovered.emit("(nodes too small to show)")
+        else:
+            record = Record(self.root.store, node)
+            self.hovered.emit("{} ({}): time {:.1f}%, alloc {:.1f}%, entries {}".format(
+                    record.name, record.module, record.inherited_time, record.inherited_alloc, record.entries))
+
+    def mouseDoubleClickEvent(self, event):
+        node = self.item_at(event.pos())
+        if node is not None and node != NO_NODE:
+            self.zoom(Record(self.root.store, node))
+
+    def resizeEvent(self, event):
+        self._update_height()
+
+class FlameView(QWidget):
+    """
+    Tab with a flame graph, it's settings and search.
+    Double click zooms into a node, Escape zooms out.
+    """
+
+    def __init__(self, root, window):
+        QWidget.__init__(self, window)
+        self.window = window
+        self.base = root
+        self.graph = FlameGraph(root, self)
+        self.graph.hovered.connect(self._on_hovered)
+
+        controls = QHBoxLayout()
+        self.key = QComboBox(self)
+        for title, key in FLAME_KEYS:
+            self.key.addItem(title, key)
+        self.key.currentIndexChanged.connect(lambda: self.graph.set_key(self.key.currentData()))
+        controls.addWidget(self.key)
+        self.search = QLineEdit(self)
+        self.search.setPlaceholderText("Highlight functions")
+        self.search.returnPressed.connect(self._on_search)
+        controls.addWidget(self.search)
+        btn = QPushButton("&Highlight", self)
+        btn.clicked.connect(self._on_search)
+        controls.addWidget(btn)
+        btn = QPushButton("&Reset zoom", self)
+        btn.clicked.connect(lambda: self.graph.zoom(self.base))
+        controls.addWidget(btn)
+
+        scroll = QScrollArea(self)
+        scroll.setWidgetResizable(True)
+        scroll.setWidget(self.graph)
+
+        layout = QVBoxLayout()
+        layout.addLayout(controls)
+        layout.addWidget(scroll)
+        self.setLayout(layout)
+
+    def _on_search(self):
+        text = self.search.text()
+        functions = []
+        if text:
+            functions = self.base.store.index().matching_functions(text, SEARCH_CONTAINS)
+        self.graph.set_highlight(functions)
+
+    def _on_hovered(self, text):
+        self.window.statusBar().showMessage(text)
+
+    def keyPressEvent(self, event):
+        root = self.graph.root
+        if event.key() == Qt.Key_Escape and root != self.base and root.parent is not None:
+            self.graph.zoom(root.parent)
+        else:
+            QWidget.keyPressEvent(self, event)
+
+class Loader(QThread):
+    """
+    Loads a profile in background thread. If path is a list, profiles
+    are merged. If compare_with is given, the result is the diff tree of
+    it and loaded profile.
+    """
+
+    # done, in 1/1000 of the file; -1 if total size is unknown
+    progress = pyqtSignal(int)
+    loaded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, path, parent, compare_with=None, fold_recursion=False, **options):
+        QThread.__init__(self, parent)
+        self.path = path
+        # the tab's tree may still be loaded while this thread runs
+        self.compare_with = None if compare_with is None else detach_tree(compare_with)
+        self.fold_recursion = fold_recursion
+        if fold_recursion:
+            # folding needs the whole tree
+            options['lazy'] = False
+        self.options = options
+
+    def _progress(self, done, total):
+        if self.isInterruptionRequested():
+            raise Cancelled()
+        if total:
+            self.progress.emit(min(1000, done * 1000 // total))
+        else:
+            self.progress.emit(-1)
+
+    def run(self):
+        try:
+            if isinstance(self.path, list):
+                table = merge_profiles(self.path, self.options.get('jobs', 1),
+                                       self.options.get('use_cache', True),
+                                       self.options.get('rebuild_cache', False), self._progress)
+            else:
+                table = load_profile(self.path, progress=self._progress, **self.options)
+        except Cancelled:
+            self.cancelled.emit()
+            return
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit(str(e))
+            return
+        if not table:
+            self.failed.emit("No cost centre tree found")
+            return
+        if self.fold_recursion:
+            table = [fold_recursion(root) for root in table]
+        if self.compare_with is not None:
+            table = [diff_trees(self.compare_with(), table[0])]
+        self.loaded.emit(table)
+
+def profile_title(path):
+    if isinstance(path, list):
+        return "{} profiles".format(len(path))
+    return os.path.basename(path)
+
+# file dialog filter -> (format, weight)
+EXPORT_FILTERS = {
+        "Collapsed stacks, time (*.folded *.txt)": (EXPORT_COLLAPSED, EXPORT_WEIGHT_TIME),
+        "Collapsed stacks, allocation (*.folded *.txt)": (EXPORT_COLLAPSED, EXPORT_WEIGHT_ALLOC),
+        "Speedscope, time (*.speedscope.json *.json)": (EXPORT_SPEEDSCOPE, EXPORT_WEIGHT_TIME),
+        "Speedscope, allocation (*.speedscope.json *.json)": (EXPORT_SPEEDSCOPE, EXPORT_WEIGHT_ALLOC),
+    }
+
+class ExportThread(QThread):
+    """
+    Writes a tree to a file in background, see export_profile.
+    """
+
+    failed = pyqtSignal(str)
+
+    def __init__(self, root, path, fmt, weight, parent):
+        QThread.__init__(self, parent)
+        self.root = root
+        self.path = path
+        self.fmt = fmt
+        self.weight = weight
+
+    def run(self):
+        try:
+            export_profile(self.root, self.path, self.fmt, self.weight)
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit(str(e))
+
+class LoadProgress(QWidget):
+    """
+    Progress bar of a Loader, with a button to cancel it.
+    """
+
+    def __init__(self, loader, parent):
+        QWidget.__init__(self, parent)
+        self.loader = loader
+        layout = QHBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(QLabel(profile_title(loader.path), self))
+        self.bar = QProgressBar(self)
+        self.bar.setRange(0, 1000)
+        self.bar.setTextVisible(False)
+        layout.addWidget(self.bar)
+        cancel = QPushButton("Cancel", self)
+        cancel.clicked.connect(loader.requestInterruption)
+        layout.addWidget(cancel)
+        self.setLayout(layout)
+        loader.progress.connect(self._on_progress)
+
+    def _on_progress(self, value):
+        if value < 0:
+            # busy indicator
+            self.bar.setRange(0, 0)
+        else:
+            self.bar.setValue(value)
+
+# number of derived trees which are computed at once
+derive_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+class DeriveThread(QThread):
+    """
+    Runs DerivedTask and watches it's progress.
+    """
+
+    # done, in 1/1000 of the work
+    progress = pyqtSignal(int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, task, parent):
+        QThread.__init__(self, parent)
+        self.task = task
+
+    def run(self):
+        while not derive_slots.acquire(timeout=0.1):
+            if self.isInterruptionRequested():
+                return
+        try:
+            task = self.task
+            task.start()
+            while not task.wait(0.1):
+                if self.isInterruptionRequested():
+                    task.cancel()
+                    return
+                if task.progress is not None:
+                    done, total = task.progress
+                    self.progress.emit(done * 1000 // total)
+        finally:
+            derive_slots.release()
+        if task.error is not None:
+            self.failed.emit(task.error)
+        else:
+            self.done.emit(task.result)
+
+class PendingView(QWidget):
+    """
+    Placeholder of a tab while it's tree is being computed.
+    """
+
+    def __init__(self, worker, title, parent):
+        QWidget.__init__(self, parent)
+        # DeriveThread, None when it is finished
+        self.worker = worker
+        layout = QVBoxLayout()
+        layout.addStretch()
+        label = QLabel("Computing {}...".format(title), self)
+        label.setAlignment(Qt.AlignCenter)
+        layout.addWidget(label)
+        self.bar = QProgressBar(self)
+        self.bar.setRange(0, 0)
+        layout.addWidget(self.bar)
+        layout.addStretch()
+        self.setLayout(layout)
+        worker.progress.connect(self._on_progress)
+        worker.finished.connect(self._on_finished)
+
+    def _on_finished(self):
+        self.worker = None
+
+    def _on_progress(self, value):
+        self.bar.setRange(0, 1000)
+        self.bar.setValue(value)
+
 class Viewer(QMainWindow):
-    def __init__(self, table):
+    def __init__(self, table=None, cache_budget=256 << 20, **load_options):
         QMainWindow.__init__(self)
+        self.load_options = load_options
+        self.cache = TreeCache(cache_budget)
+        # path -> store of the profile loaded from it, while it is in use
+        self.profiles = weakref.WeakValueDictionary()
         self.tabs = QTabWidget(self)
-        main = TreeView(table, self)
-        self.tabs.addTab(main, "All")
+        self.tabs.setTabsClosable(True)
+        self.tabs.tabCloseRequested.connect(self._on_close_tab)
+        if table is not None:
+            main = TreeView(table, self)
+            self.tabs.addTab(main, "All")
         self.setCentralWidget(self.tabs)
+
+        menu = self.menuBar().addMenu("&File")
+        menu.addAction("&Open...", self._on_open, QKeySequence.Open)
+        menu.addAction("&Merge profiles...", self._on_merge)
+        menu.addAction("&Compare with...", self._on_compare)
+        menu.addAction("&Export...", self._on_export)
+        menu.addSeparator()
+        menu.addAction("&Quit", self.close, QKeySequence.Quit)
+
+        menu = self.menuBar().addMenu("&View")
+        menu.addAction("&Flame graph", self._on_flame_graph, "Ctrl+G")
+        menu.addAction("F&lat profile", self._on_flat_profile, "Ctrl+L")
+        menu.addAction("Fold &recursion", self._on_fold_recursion, "Ctrl+R")
+
+        self.cache_label = QLabel(str(self.cache), self)
+        self.statusBar().addPermanentWidget(self.cache_label)
         self.statusBar().showMessage("Ready.")
 
-    def make_item_menu(self, model, record):
-        def reverse_search():
-            root = model.record
-            reverse = root.reverse_tree(record)
+    def open(self, path, compare_with=None):
+        """
+        Start loading of a profile; it is shown in a new tab when ready.
+        A list of paths is loaded as one merged profile. With compare_with,
+        differences from that tree are shown instead.
+        """
+        loader = Loader(path, self, compare_with, **self.load_options)
+        progress = LoadProgress(loader, self)
+        self.statusBar().addPermanentWidget(progress)
+
+        title = profile_title(path)
+        if isinstance(path, list):
+            title = "Merged: {}".format(title)
+        if compare_with is not None:
+            title = "Diff: {}".format(title)
+
+        def loaded(table):
+            if compare_with is None and not isinstance(path, list):
+                previous = self.profiles.get(path)
+                if previous is not None:
+                    self.cache.invalidate(previous)
+                    self.cache_label.setText(str(self.cache))
+                self.profiles[path] = table[0].store
+            widget = TreeView(table[0], self)
+            index = self.tabs.addTab(widget, title)
+            self.tabs.setCurrentIndex(index)
+            self.statusBar().showMessage("Loaded {}".format(title))
+
+        def failed(message):
+            self.statusBar().showMessage("Can't load {}: {}".format(title, message))
+
+        def cancelled():
+            self.statusBar().showMessage("Loading of {} cancelled".format(title))
+
+        def finished():
+            self.statusBar().removeWidget(progress)
+            progress.deleteLater()
+            loader.deleteLater()
+
+        loader.loaded.connect(loaded)
+        loader.failed.connect(failed)
+        loader.cancelled.connect(cancelled)
+        loader.finished.connect(finished)
+        self.statusBar().showMessage("Loading {}...".format(title))
+        loader.start()
+        return loader
+
+    def _on_open(self):
+        path, _ = QFileDialog.getOpenFileName(self, "Open profile", "",
+                    "GHC profiles (*.prof *.json);;All files (*)")
+        if path:
+            self.open(path)
+
+    def _on_merge(self):
+        paths, _ = QFileDialog.getOpenFileNames(self, "Merge profiles", "",
+                    "GHC profiles (*.prof *.json);;All files (*)")
+        if paths:
+            self.open(paths)
+
+    def _on_compare(self):
+        current = self.tabs.currentWidget()
+        if not isinstance(current, TreeView):
+            self.statusBar().showMessage("Select a tab with the profile to compare with")
+            return
+        path, _ = QFileDialog.getOpenFileName(self, "Compare with profile", "",
+                    "GHC profiles (*.prof *.json);;All files (*)")
+        if path:
+            self.open(path, current.model.record)
+
+    def _on_export(self):
+        current = self.tabs.currentWidget()
+        if not isinstance(current, TreeView):
+            self.statusBar().showMessage("Select a tab with a tree to export")
+            return
+        path, selected = QFileDialog.getSaveFileName(self, "Export", "", ";;".join(EXPORT_FILTERS))
+        if not path:
+            return
+        fmt, weight = EXPORT_FILTERS.get(selected, (EXPORT_COLLAPSED, EXPORT_WEIGHT_TIME))
+        self.export(current.model.record, path, fmt, weight)
+
+    def export(self, root, path, fmt, weight):
+        thread = ExportThread(root, path, fmt, weight, self)
+        failed = []
+
+        def on_failed(message):
+            failed.append(message)
+            self.statusBar().showMessage("Can't export to {}: {}".format(path, message))
+
+        def finished():
+            if not failed:
+                self.statusBar().showMessage("Exported to {}".format(path))
+            thread.deleteLater()
+
+        thread.failed.connect(on_failed)
+        thread.finished.connect(finished)
+        self.statusBar().showMessage("Exporting to {}...".format(path))
+        thread.start()
+        return thread
+
+    def closeEvent(self, event):
+        for thread in self.findChildren(QThread):
+            thread.requestInterruption()
+            thread.wait()
+        QMainWindow.closeEvent(self, event)
+
+    def derive(self, kind, root, record, title, **options):
+        """
+        Compute derived tree in background; a placeholder tab is shown
+        until it is ready, closing it cancels the computation. Trees of
+        calls are taken from the cache when they were computed before.
+        """
+        if root.store.baseline is not None:
+            self.statusBar().showMessage("Can't compute {}: derived trees of a comparison are not supported".format(title))
+            return None
+        key = None
+        # pruned trees are expanded in place, so they are not shared
+        if kind != DERIVE_PRUNE:
+            key = self.cache.key(kind, root, record)
+            tree = self.cache.get(key)
+            self.cache_label.setText(str(self.cache))
+            if tree is not None:
+                widget = TreeView(tree, self, root)
+                self.tabs.addTab(widget, title)
+                self.tabs.setCurrentWidget(widget)
+                return None
+
+        thread = DeriveThread(DerivedTask(kind, root, record, **options), self)
+        placeholder = PendingView(thread, title, self)
+        self.tabs.addTab(placeholder, title)
+        self.tabs.setCurrentWidget(placeholder)
+
+        def done(tree):
+            if key is not None:
+                self.cache.put(key, tree)
+                self.cache_label.setText(str(self.cache))
+            index = self.tabs.indexOf(placeholder)
+            if index < 0:
+                return
+            current = self.tabs.currentIndex() == index
+            self.tabs.removeTab(index)
+            self.tabs.insertTab(index, TreeView(tree, self, root), title)
+            if current:
+                self.tabs.setCurrentIndex(index)
+            placeholder.deleteLater()
+
+        def failed(message):
+            self.statusBar().showMessage("Can't compute {}: {}".format(title, message))
+
+        thread.done.connect(done)
+        thread.failed.connect(failed)
+        thread.finished.connect(thread.deleteLater)
+        thread.start()
+        return thread
+
+    def narrow(self, root, record, title):
+        """
+        Tab with the subtree of record; it shares the store with the tab
+        of root, so nothing is copied.
+        """
+        widget = TreeView(record, self, root, show_root=True)
+        self.tabs.addTab(widget, title)
+        self.tabs.setCurrentWidget(widget)
+        return widget
+
+    def _on_close_tab(self, index):
+        widget = self.tabs.widget(index)
+        self.tabs.removeTab(index)
+        if isinstance(widget, TreeView):
+            store = widget.model.record.store
+            if not any(isinstance(other, TreeView) and other.model.record.store is store
+                       for other in map(self.tabs.widget, range(self.tabs.count()))):
+                self.cache.invalidate(store)
+                self.cache_label.setText(str(self.cache))
+        if isinstance(widget, PendingView) and widget.worker is not None:
+            widget.worker.requestInterruption()
+        # threads of the tab itself, e.g. search
+        for thread in widget.findChildren(QThread):
+            thread.requestInterruption()
+            thread.wait()
+        widget.deleteLater()
+
+    def show_flame_graph(self, record, title):
+        widget = FlameView(record, self)
+        self.tabs.addTab(widget, title)
+        self.tabs.setCurrentWidget(widget)
+
+    def _on_flame_graph(self):
+        current = self.tabs.currentWidget()
+        if not isinstance(current, TreeView):
+            self.statusBar().showMessage("Select a tab with a tree to show it's flame graph")
+            return
+        self.show_flame_graph(current.model.record,
+                "Flame graph: {}".format(self.tabs.tabText(self.tabs.currentIndex())))
 
-            widget = TreeView(reverse, self)
-            self.tabs.addTab(widget, "Calls to {}".format(record.name))
+    def _on_flat_profile(self):
+        current = self.tabs.currentWidget()
+        if not isinstance(current, TreeView):
+            self.statusBar().showMessage("Select a tab with a tree to show it's flat profile")
+            return
+        root = current.model.record
+        self.derive(DERIVE_FLAT, root, root,
+                "Flat profile: {}".format(self.tabs.tabText(self.tabs.currentIndex())))
+
+    def _on_fold_recursion(self):
+        current = self.tabs.currentWidget()
+        if not isinstance(current, TreeView):
+            self.statusBar().showMessage("Select a tab with a tree to fold recursion in")
+            return
+        root = current.model.record
+        self.derive(DERIVE_FOLD, root, root,
+                "Folded recursion: {}".format(self.tabs.tabText(self.tabs.currentIndex())))
+
+    def find_tree(self, root):
+        """
+        Tab which shows the tree of root, or None.
+        """
+        for i in range(self.tabs.count()):
+            widget = self.tabs.widget(i)
+            if isinstance(widget, TreeView) and widget.model.record == root:
+                return widget
+        return None
+
+    def show_occurrences(self, source, record):
+        widget = self.find_tree(source)
+        if widget is None:
+            self.statusBar().showMessage("The tab this view was made from is closed")
+            return
+        self.tabs.setCurrentWidget(widget)
+        widget.show_occurrences(record)
 
-        def forward_search():
-            root = model.record
-            tree = root.forward_tree(record)
+    def make_item_menu(self, model, record, view=None):
+        def reverse_search():
+            self.derive(DERIVE_CALLERS, model.record, record, "Calls to {}".format(record.name))
 
-            widget = TreeView(tree, self)
-            self.tabs.addTab(widget, "Calls of {}".format(record.name))
+        def forward_search():
+            self.derive(DERIVE_CALLEES, model.record, record, "Calls of {}".format(record.name))
 
         def focus():
-            root = Record.new(record.get_max_id(), "Root")
-            root.add_child(record)
-            widget = TreeView(root, self)
-            self.tabs.addTab(widget, "Narrowed view: {}".format(record.name))
+            self.narrow(model.record, record, "Narrowed view: {}".format(record.name))
+
+        def flame():
+            self.show_flame_graph(record, "Flame graph: {}".format(record.name))
+
+        def flat():
+            self.derive(DERIVE_FLAT, model.record, record, "Flat profile: {}".format(record.name))
 
         menu = QMenu(self)
+        # derived trees of a comparison would lose the baseline
+        derived = model.record.store.baseline is None
         menu.addAction("Narrow view to this item").triggered.connect(focus)
-        menu.addAction("Group all outgoing calls").triggered.connect(forward_search)
-        menu.addAction("Group all incoming calls").triggered.connect(reverse_search)
+        if derived:
+            menu.addAction("Group all outgoing calls").triggered.connect(forward_search)
+            menu.addAction("Group all incoming calls").triggered.connect(reverse_search)
+        menu.addAction("Flame graph of this item").triggered.connect(flame)
+        if derived:
+            menu.addAction("Flat profile of this item").triggered.connect(flat)
+        if view is not None and view.source is not None:
+            menu.addSeparator()
+            menu.addAction("Show occurrences in source tab").triggered.connect(
+                    lambda: self.show_occurrences(view.source, record))
 
         return menu
 
 if __name__ == "__main__":
-#     root = Record.new(0, "root", "root", "root")
-#     Record.insert(root, [Record.new(1), Record.new(4), Record.new(51, name="5")])
-#     Record.insert(root, [Record.new(2), Record.new(4), Record.new(52, name="5")])
-#     Record.insert(root, [Record.new(7), Record.new(4), Record.new(60)])
-#     Record.insert(root, [Record.new(3), Record.new(4), Record.new(53, name="5")])
-#     Record.insert(root, [Record.new(3), Record.new(4), Record.new(54, name="5")])
-#     root.flatten()
-#     print_table([root])
-# 
-#     new_root = root.forward_tree(Record.new(4))
-#     print_table([new_root])
-
-    path = sys.argv[1]
-    with open(path) as f:
-        table = parse_file(f)
+    parser = argparse.ArgumentParser(description="GHC .prof files viewer")
+    parser.add_argument("path", nargs='*', help="path to .prof file")
+    parser.add_argument("--merge", action='store_true',
+                        help="merge given profiles into one")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of processes used to parse the file")
+    parser.add_argument("--no-cache", action='store_true',
+                        help="do not read or write {} cache file".format(CACHE_SUFFIX))
+    parser.add_argument("--rebuild-cache", action='store_true',
+                        help="parse the file even if cache is up to date")
+    parser.add_argument("--lazy", action='store_true',
+                        help="parse only top levels of the tree, load subtrees when they are expanded")
+    parser.add_argument("--fold-recursion", action='store_true',
+                        help="fold recursive calls into the outermost call of the function")
+    parser.add_argument("--cache-budget", type=int, default=256, metavar="MB",
+                        help="memory for derived trees which are kept for reuse")
+    args = parser.parse_args()
 
     app = QApplication(sys.argv)
-    window = Viewer(table[0])
+    window = Viewer(cache_budget = args.cache_budget << 20,
+                    jobs = args.jobs,
+                    use_cache = not args.no_cache,
+                    rebuild_cache = args.rebuild_cache,
+                    lazy = args.lazy,
+                    fold_recursion = args.fold_recursion)
     window.show()
+    if args.merge and len(args.path) > 1:
+        window.open(args.path)
+    else:
+        for path in args.path:
+            window.open(path)
 
     sys.exit(app.exec_())
 
@@ -0,0 +1,128 @@
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ghcprof
+
+PROF_HEADER = """\tSat Oct 17 12:00 2026 Time and Allocation Profiling Report  (Final)
+
+\t   prog +RTS -p -RTS
+
+\ttotal time  =        {seconds:.2f} secs   ({ticks} ticks @ 1000 us, 1 processor)
+\ttotal alloc = {alloc:,} bytes  (excludes profiling overheads)
+
+COST CENTRE MODULE SRC %time %alloc
+
+MAIN MAIN <built-in> 100.0 100.0
+
+                                  individual      inherited
+COST CENTRE MODULE SRC no. entries %time %alloc %time %alloc
+
+"""
+
+def prof_text(rows, ticks=1000, alloc=1000000):
+    """
+    Text of .prof file with given rows of the cost-centre tree:
+    (depth, name, module, src, no, entries, time, alloc) in preorder.
+    Inherited values are sums over subtrees.
+    """
+    inherited = []
+    for i, row in enumerate(rows):
+        time, alloc_ = row[6], row[7]
+        for other in rows[i+1:]:
+            if other[0] <= row[0]:
+                break
+            time += other[6]
+            alloc_ += other[7]
+        inherited.append((time, alloc_))
+    lines = [PROF_HEADER.format(seconds=ticks / 1000.0, ticks=ticks, alloc=alloc)]
+    for (depth, name, module, src, no, entries, time, alloc_), (inh_time, inh_alloc) in zip(rows, inherited):
+        lines.append("{}{} {} {} {} {} {:.1f} {:.1f} {:.1f} {:.1f}\n".format(
+                " " * depth, name, module, src, no, entries, time, alloc_, inh_time, inh_alloc))
+    return "".join(lines)
+
+def random_rows(count, seed=1, functions=12):
+    """
+    Rows of a random tree (see prof_text) where functions repeat, also
+    recursively.
+    """
+    rng = random.Random(seed)
+    parents = [None]
+    for node in range(1, count):
+        # prefer recent nodes, for deeper trees
+        parents.append(rng.randrange(max(0, node - 8), node))
+    children = [[] for _ in range(count)]
+    for node, parent in enumerate(parents[1:], 1):
+        children[parent].append(node)
+    rows = []
+    stack = [(0, 0)]
+    while stack:
+        node, depth = stack.pop()
+        if node == 0:
+            name, module, src = "MAIN", "MAIN", "<built-in>"
+        else:
+            f = rng.randrange(functions)
+            name, module, src = "f{}".format(f), "Mod{}".format(f % 3), "Mod{}.hs:{}:1-20".format(f % 3, f)
+        rows.append((depth, name, module, src, 100 + node, rng.randrange(1, 1000),
+                     rng.randrange(0, 20) / 10.0, rng.randrange(0, 20) / 10.0))
+        stack.extend((child, depth + 1) for child in reversed(children[node]))
+    return rows
+
+def tree_rows(record):
+    """
+    Nodes of the tree of record in preorder, as comparable tuples.
+    """
+    store = record.store
+    result = []
+    stack = [(record.id, 0)]
+    while stack:
+        node, depth = stack.pop()
+        r = ghcprof.Record(store, node)
+        result.append((depth, r.name, r.module, r.src, r.no, r.entries,
+                       round(r.individual_time, 6), round(r.individual_alloc, 6),
+                       round(r.inherited_time, 6), round(r.inherited_alloc, 6)))
+        stack.extend((child, depth + 1) for child in reversed(list(store.iter_children(node))))
+    return result
+
+@pytest.fixture
+def write_prof(tmp_path):
+    """
+    Function which writes rows (see prof_text) to a .prof file in a
+    temporary directory and returns it's path.
+    """
+    def write(name, rows, **totals):
+        path = tmp_path / name
+        path.write_text(prof_text(rows, **totals))
+        return str(path)
+    return write
+
+@pytest.fixture
+def profile_path(write_prof):
+    return write_prof("random.prof", random_rows(600))
+
+def run_rows(caller):
+    return [(0, "MAIN", "MAIN", "<built-in>", 1, 0, 0.0, 0.0),
+            (1, caller, "M", "M.hs:2", 2, 1, 0.0, 0.0),
+            (2, "f", "M", "M.hs:1", 3, 1, 100.0, 100.0)]
+
+@pytest.fixture
+def runs(write_prof):
+    """
+    Two runs with the same numbers of nodes, which call f from
+    different functions.
+    """
+    return [write_prof("m1.prof", run_rows("a"), ticks=100, alloc=100),
+            write_prof("m2.prof", run_rows("b"), ticks=100, alloc=100)]
+
+def calls_of_f(root):
+    """
+    Root of the tree of calls of f of the runs, merged.
+    """
+    store = root.store
+    needle = ghcprof.Record(store, store.index().find([store.functions.find("f", "M", "M.hs:1")])[0])
+    tree = root.forward_tree(needle)
+    return next(iter(tree.children))
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import ghcprof
+from conftest import tree_rows
+
+def test_round_trip(profile_path):
+    parsed = ghcprof.load_profile(profile_path)[0]
+    assert os.path.exists(ghcprof.cache_path(profile_path))
+    cached = ghcprof.load_cache(profile_path)
+    assert cached is not None
+    root = cached[0]
+    assert tree_rows(root) == tree_rows(parsed)
+    assert root.store.total_ticks == parsed.store.total_ticks
+    assert root.store.total_alloc == parsed.store.total_alloc
+    assert ghcprof.load_profile(profile_path)[0].store._mapping is not None
+
+def test_outdated(profile_path):
+    ghcprof.load_profile(profile_path)
+    with open(profile_path, 'a') as f:
+        f.write("\n")
+    assert ghcprof.load_cache(profile_path) is None
+
+def test_truncated(profile_path):
+    parsed = ghcprof.load_profile(profile_path)[0]
+    cache = ghcprof.cache_path(profile_path)
+    with open(cache, 'rb') as f:
+        data = f.read()
+    for size in [10, 2000, len(data) // 2, len(data) - 1]:
+        with open(cache, 'wb') as f:
+            f.write(data[:size])
+        assert ghcprof.load_cache(profile_path) is None
+    # a damaged cache is replaced
+    assert tree_rows(ghcprof.load_profile(profile_path)[0]) == tree_rows(parsed)
+    assert ghcprof.load_cache(profile_path) is not None
+
+def test_bad_column_length(profile_path):
+    ghcprof.load_profile(profile_path)
+    cache = ghcprof.cache_path(profile_path)
+    with open(cache, 'rb') as f:
+        data = bytearray(f.read())
+    # length of the first column
+    offset = ghcprof.CACHE_HEADER.size + ghcprof.CACHE_COLUMN.size - 8
+    data[offset : offset + 8] = (5).to_bytes(8, sys.byteorder)
+    with open(cache, 'wb') as f:
+        f.write(data)
+    assert ghcprof.load_cache(profile_path) is None
+
+def test_cached_store_changed(profile_path):
+    ghcprof.load_profile(profile_path)
+    root = ghcprof.load_cache(profile_path)[0]
+    store = root.store
+    size = len(store)
+    child = ghcprof.Record.new(store, "new", "M", "M.hs:1", individual_time = 2.0, parent = root)
+    assert store._mapping is None
+    store.fill_inherited()
+    assert len(store) == size + 1
+    assert child.inherited_time == 2.0
+    assert child.parent == root
+
+def test_rebuild_cache(profile_path, capsys):
+    ghcprof.load_profile(profile_path)
+    cache = ghcprof.cache_path(profile_path)
+    os.utime(cache, ns=(0, 0))
+    assert ghcprof.main(["top", "-n", "1", "--rebuild-cache", profile_path]) == 0
+    assert os.stat(cache).st_mtime_ns != 0
+    assert ghcprof.load_cache(profile_path) is not None
@@ -0,0 +1,26 @@
+import io
+import json
+
+import ghcprof
+from conftest import random_rows
+
+def test_tree_json(write_prof):
+    with open(write_prof("random.prof", random_rows(300))) as f:
+        root = ghcprof.parse_file(f)[0]
+    keep = lambda record: record.inherited_time >= 1.0
+    out = io.StringIO()
+    ghcprof.write_tree_json(root, 6, keep, out)
+    assert out.getvalue() == json.dumps(ghcprof.tree_json(root, 6, keep), indent=2)
+
+def test_deep_tree_json(write_prof):
+    count = 1500
+    rows = [(i, "f{}".format(i % 5), "M", "M.hs:{}".format(i % 5), i + 1, 1, 0.0, 0.0) for i in range(count)]
+    with open(write_prof("deep.prof", rows)) as f:
+        root = ghcprof.parse_file(f)[0]
+    out = io.StringIO()
+    ghcprof.write_tree_json(root, count, out=out)
+    item = ghcprof.tree_json(root, count)
+    for _ in range(count - 1):
+        item, = item["children"]
+    assert item["children"] == []
+    assert out.getvalue().count('"children": []') == 1
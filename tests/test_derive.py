@@ -0,0 +1,183 @@
+import gc
+import weakref
+
+import pytest
+
+import ghcprof
+
+def key(store, node):
+    functions = store.functions
+    function = store.function[node]
+    return (functions.names[function], functions.modules[function], functions.srcs[function])
+
+def subtree(store, node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(list(store.iter_children(node))))
+
+def add(result, path, store, node):
+    # each source node is counted once per result node
+    values, nodes = result.setdefault(path, ([0, 0.0, 0.0], set()))
+    if node not in nodes:
+        nodes.add(node)
+        values[0] += store.entries[node]
+        values[1] += store.individual_time[node]
+        values[2] += store.individual_alloc[node]
+
+def reference_callees(root, needle):
+    """
+    Callees tree of needle, by call paths: values of all source nodes at
+    the same path from any call of needle.
+    """
+    store = root.store
+    result = dict()
+    for call in subtree(store, root.id):
+        if key(store, call) != needle:
+            continue
+        stack = [(call, (needle,))]
+        while stack:
+            node, path = stack.pop()
+            add(result, path, store, node)
+            stack.extend((child, path + (key(store, child),)) for child in store.iter_children(node))
+    return result
+
+def reference_callers(root, needle):
+    """
+    Callers tree of needle: chains of callers of outermost calls, up to
+    root, merged by paths.
+    """
+    store = root.store
+    result = dict()
+    for call in subtree(store, root.id):
+        if key(store, call) != needle:
+            continue
+        node = store.parent[call]
+        nested = False
+        while node != ghcprof.NO_NODE:
+            if key(store, node) == needle:
+                nested = True
+            if node == root.id:
+                break
+            node = store.parent[node]
+        if nested:
+            continue
+        path = ()
+        node = call
+        while node != root.id:
+            path += (key(store, node),)
+            add(result, path, store, node)
+            node = store.parent[node]
+    return result
+
+def paths(tree):
+    """
+    Values of nodes of a derived tree by their paths below it's root.
+    """
+    store = tree.store
+    result = dict()
+    stack = [(child, ()) for child in store.iter_children(tree.id)]
+    while stack:
+        node, path = stack.pop()
+        path += (key(store, node),)
+        assert path not in result
+        result[path] = [store.entries[node], store.individual_time[node], store.individual_alloc[node]]
+        stack.extend((child, path) for child in store.iter_children(node))
+    return result
+
+def assert_same(tree, expected):
+    actual = paths(tree)
+    assert sorted(actual) == sorted(expected)
+    for path, (entries, time, alloc) in actual.items():
+        values = expected[path][0]
+        assert entries == values[0]
+        assert time == pytest.approx(values[1])
+        assert alloc == pytest.approx(values[2])
+
+@pytest.fixture
+def root(profile_path):
+    with open(profile_path) as f:
+        return ghcprof.parse_file(f)[0]
+
+FUNCTIONS = [("f{}".format(f), "Mod{}".format(f % 3), "Mod{}.hs:{}:1-20".format(f % 3, f)) for f in (0, 5, 11)]
+
+def needle_of(root, function):
+    store = root.store
+    return ghcprof.Record(store, store.index().find([store.functions.find(*function)], root.id)[0])
+
+@pytest.mark.parametrize("function", FUNCTIONS)
+def test_callees(root, function):
+    expected = reference_callees(root, function)
+    assert len(expected) > 1
+    assert_same(root.forward_tree(needle_of(root, function)), expected)
+
+@pytest.mark.parametrize("function", FUNCTIONS)
+def test_callers(root, function):
+    expected = reference_callers(root, function)
+    assert len(expected) > 1
+    assert_same(root.reverse_tree(needle_of(root, function)), expected)
+
+def test_within_subtree(root):
+    top = max(root.children, key=lambda child: len(list(subtree(root.store, child.id))))
+    function = FUNCTIONS[1]
+    needle = needle_of(top, function)
+    assert_same(top.reverse_tree(needle), reference_callers(top, function))
+    assert_same(top.forward_tree(needle), reference_callees(top, function))
+
+def test_derived_in_worker(root):
+    task = ghcprof.DerivedTask(ghcprof.DERIVE_CALLEES, root, needle_of(root, FUNCTIONS[0]))
+    task.start()
+    while not task.wait(0.1):
+        pass
+    assert task.error is None
+    assert_same(task.result, reference_callees(root, FUNCTIONS[0]))
+
+def test_pruned_aggregates_apart(write_prof):
+    # two aggregates of the same number of nodes under different parents
+    rows = [(0, "MAIN", "MAIN", "<built-in>", 1, 0, 0.0, 0.0),
+            (1, "a", "M", "M.hs:1", 2, 1, 30.0, 30.0),
+            (2, "x", "M", "M.hs:3", 3, 1, 0.1, 0.1),
+            (2, "y", "M", "M.hs:4", 4, 1, 0.2, 0.2),
+            (1, "b", "M", "M.hs:2", 5, 1, 30.0, 30.0),
+            (2, "z", "M", "M.hs:5", 6, 1, 0.3, 0.3),
+            (2, "w", "M", "M.hs:6", 7, 1, 0.4, 0.4)]
+    with open(write_prof("pruned.prof", rows)) as f:
+        root = ghcprof.parse_file(f)[0]
+    pruned = ghcprof.prune_tree(root, 1.0, 1.0)
+    store = pruned.store
+    aggregates = [node for node in range(len(store)) if store.is_aggregate(node)]
+    assert len(aggregates) == 2
+    assert store.function[aggregates[0]] == store.function[aggregates[1]]
+    assert store.no[aggregates[0]] != store.no[aggregates[1]]
+
+    callees = pruned.forward_tree(pruned)
+    tree = callees.store
+    kept = [node for node in range(len(tree)) if tree.is_aggregate(node)]
+    assert sorted(tree.inherited_time[node] for node in kept) == pytest.approx([0.3, 0.7])
+
+    # callees of an aggregate are of that aggregate only
+    one = pruned.forward_tree(ghcprof.Record(store, aggregates[1]))
+    assert one.store.inherited_time[one.id] == pytest.approx(0.7)
+
+    folded = ghcprof.fold_recursion(pruned)
+    assert sum(folded.store.is_aggregate(node) for node in range(len(folded.store))) == 2
+
+def test_cache_releases_store(profile_path):
+    cache = ghcprof.TreeCache(1 << 30)
+    with open(profile_path) as f:
+        root = ghcprof.parse_file(f)[0]
+    needle = needle_of(root, FUNCTIONS[0])
+    for kind in [ghcprof.DERIVE_CALLEES, ghcprof.DERIVE_FLAT]:
+        cache.put(cache.key(kind, root, needle), ghcprof.derive(kind, root, needle))
+    assert len(cache) == 2
+    assert cache.get(cache.key(ghcprof.DERIVE_CALLEES, root, needle)) is not None
+    cache.invalidate(root.store)
+    assert len(cache) == 0 and cache.size == 0
+
+    cache.put(cache.key(ghcprof.DERIVE_CALLERS, root, needle), ghcprof.derive(ghcprof.DERIVE_CALLERS, root, needle))
+    store = weakref.ref(root.store)
+    del root, needle
+    gc.collect()
+    assert store() is None
+    assert len(cache) == 0 and cache.size == 0
@@ -0,0 +1,37 @@
+import pytest
+
+import ghcprof
+from conftest import calls_of_f, tree_rows
+
+def test_diff(runs):
+    before, after = [ghcprof.load_profile(path, use_cache=False)[0] for path in runs]
+    root = ghcprof.diff_trees(before, after)
+    store = root.store
+    assert len(set(store.no)) == len(store)
+    rows = [(depth, name, ghcprof.Record(store, node).change)
+            for (depth, name, *_), node in zip(tree_rows(root), store.index().subtree(root.id))]
+    assert rows == [(0, "Root", ""), (1, "MAIN", ""), (2, "a", "removed"), (3, "f", "removed"),
+                    (2, "b", "added"), (3, "f", "added")]
+    f = calls_of_f(root)
+    assert f.entries == 1
+    assert f.inherited_time == pytest.approx(100.0)
+
+def test_diff_not_derived(runs):
+    before, after = [ghcprof.load_profile(path, use_cache=False)[0] for path in runs]
+    root = ghcprof.diff_trees(before, after)
+    for kind in [ghcprof.DERIVE_CALLEES, ghcprof.DERIVE_FLAT]:
+        with pytest.raises(ValueError):
+            ghcprof.derive(kind, root, root)
+
+def test_diff_detached(runs, profile_path):
+    before, after = [ghcprof.load_profile(path, use_cache=False)[0] for path in runs]
+    expected = tree_rows(ghcprof.diff_trees(before, after))
+    assert tree_rows(ghcprof.diff_trees(ghcprof.detach_tree(before)(), after)) == expected
+
+    # a lazily loaded tree is compared in whole
+    with open(profile_path) as f:
+        full = ghcprof.parse_file(f)[0]
+    lazy = ghcprof.parse_lazy(profile_path)[0]
+    detached = ghcprof.detach_tree(lazy)
+    assert lazy.store.loader.pending
+    assert tree_rows(detached()) == tree_rows(full)
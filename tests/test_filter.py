@@ -0,0 +1,28 @@
+import ghcprof
+from conftest import prof_text
+
+ROWS = [(0, "MAIN", "MAIN", "<built-in>", 1, 0, 0.0, 0.0),
+        (1, "a", "M", "M.hs:1", 2, 1, 10.0, 10.0),
+        (2, "b", "M", "M.hs:2", 3, 1, 20.0, 20.0),
+        (3, "c", "M", "M.hs:3", 4, 1, 30.0, 30.0),
+        (2, "d", "M", "M.hs:4", 5, 1, 40.0, 40.0)]
+
+def shown_names(store, shown):
+    return sorted(ghcprof.Record(store, node).name for node in range(len(store)) if shown[node])
+
+def test_filter(tmp_path):
+    path = tmp_path / "filter.prof"
+    path.write_text(prof_text(ROWS))
+    with open(str(path)) as f:
+        root = ghcprof.parse_file(f)[0]
+    store = root.store
+    a = root.children[0]
+    b = a.children[0]
+    functions = [b.function]
+    # ancestors and descendants of matches are shown, root is not
+    assert shown_names(store, store.filter(root.id, functions)) == ["a", "b", "c"]
+    assert shown_names(store, store.filter(root.id, functions, inherited_time=60.0)) == []
+    # a displayed root which matches shows it's subtree
+    assert shown_names(store, store.filter(a.id, [a.function])) == []
+    assert shown_names(store, store.filter(a.id, [a.function], include_root=True)) == ["a", "b", "c", "d"]
+    assert shown_names(store, store.filter(b.id, [store.functions.find("d", "M", "M.hs:4")], include_root=True)) == []
@@ -0,0 +1,30 @@
+import pytest
+
+import ghcprof
+from conftest import calls_of_f, run_rows, random_rows, tree_rows
+
+def test_merge(runs):
+    root = ghcprof.merge_profiles(runs, use_cache=False)[0]
+    store = root.store
+    assert store.total_ticks == 200
+    assert len(set(store.no)) == len(store)
+    assert [(depth, name, entries, time) for depth, name, _, _, _, entries, time, _, _, _ in tree_rows(root)] == [
+        (0, "MAIN", 0, 0.0), (1, "a", 1, 0.0), (2, "f", 1, 50.0), (1, "b", 1, 0.0), (2, "f", 1, 50.0)]
+    f = calls_of_f(root)
+    assert f.entries == 2
+    assert f.inherited_time == pytest.approx(100.0)
+
+def test_merge_weights(write_prof):
+    light = write_prof("light.prof", run_rows("a"), ticks=100, alloc=100)
+    heavy = write_prof("heavy.prof", run_rows("b"), ticks=300, alloc=100)
+    root = ghcprof.merge_profiles([light, heavy], use_cache=False)[0]
+    assert [child.inherited_time for child in root.children] == pytest.approx([25.0, 75.0])
+    assert [child.inherited_alloc for child in root.children] == pytest.approx([50.0, 50.0])
+
+def test_merge_parallel(write_prof):
+    paths = [write_prof("run{}.prof".format(i), random_rows(300, seed=i, functions=6)) for i in range(4)]
+    serial = ghcprof.merge_profiles(paths, use_cache=False)[0]
+    parallel = ghcprof.merge_profiles(paths, jobs=2, use_cache=False)[0]
+    rows = lambda root: sorted(row[:4] + row[5:] for row in tree_rows(root))
+    assert rows(parallel) == pytest.approx(rows(serial))
+    assert len(set(parallel.store.no)) == len(parallel.store)
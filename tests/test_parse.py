@@ -0,0 +1,101 @@
+import io
+import json
+
+import pytest
+
+import ghcprof
+from conftest import random_rows, tree_rows
+
+def test_mapped(profile_path):
+    with open(profile_path) as f:
+        table = ghcprof.parse_file(f)
+    assert len(table) == 1
+    root = table[0]
+    assert root.name == "MAIN"
+    assert len(root.store) == 600
+    assert root.store.total_ticks == 1000
+    assert root.store.total_alloc == 1000000
+    rows = tree_rows(root)
+    expected = random_rows(600)
+    assert [row[:6] for row in rows] == [row[:6] for row in expected]
+
+def test_stream_matches_mapped(profile_path):
+    with open(profile_path) as f:
+        mapped = ghcprof.parse_file(f)[0]
+    with open(profile_path) as f:
+        stream = ghcprof.parse_file(io.StringIO(f.read()))[0]
+    assert tree_rows(stream) == tree_rows(mapped)
+    assert stream.store.total_ticks == mapped.store.total_ticks
+
+def test_parallel_matches_serial(profile_path, monkeypatch):
+    with open(profile_path) as f:
+        serial = ghcprof.parse_file(f)[0]
+    monkeypatch.setattr(ghcprof, "CHUNK_SIZE", 512)
+    with open(profile_path, 'rb') as f:
+        parallel = ghcprof.parse_file(f, jobs=2)[0]
+    assert tree_rows(parallel) == tree_rows(serial)
+    assert parallel.store.total_alloc == serial.store.total_alloc
+
+def test_small_chunks(profile_path, monkeypatch):
+    with open(profile_path) as f:
+        serial = ghcprof.parse_file(f)[0]
+    monkeypatch.setattr(ghcprof, "CHUNK_SIZE", 100)
+    with open(profile_path) as f:
+        chunked = ghcprof.parse_file(f)[0]
+    assert tree_rows(chunked) == tree_rows(serial)
+
+def test_lazy_loads_everything(profile_path):
+    with open(profile_path) as f:
+        full = ghcprof.parse_file(f)[0]
+    root = ghcprof.parse_lazy(profile_path)[0]
+    loader = root.store.loader
+    assert loader.pending
+    while loader.pending:
+        loader.fetch(next(iter(loader.pending)))
+    assert tree_rows(root) == tree_rows(full)
+
+@pytest.mark.parametrize("text", ["", "no table here\n"])
+def test_no_table(tmp_path, text):
+    path = tmp_path / "bad.prof"
+    path.write_text(text)
+    with open(str(path)) as f:
+        with pytest.raises(ValueError):
+            ghcprof.parse_file(f)
+    with pytest.raises(ValueError):
+        ghcprof.parse_file(io.StringIO(text))
+
+JSON_PROFILE = {
+    "program": "prog",
+    "total_ticks": 200,
+    "total_alloc": 4000,
+    "cost_centres": [
+        {"id": 1, "label": "MAIN", "module": "MAIN", "src_loc": "<built-in>", "is_caf": False},
+        {"id": 2, "label": "main", "module": "Main", "src_loc": "Main.hs:3:1-20", "is_caf": False},
+        {"id": 3, "label": "go", "module": "Main", "src_loc": "<no location info>", "is_caf": False},
+    ],
+    "profile": {"id": 1, "entries": 0, "alloc": 400, "ticks": 20, "children": [
+        {"id": 2, "entries": 1, "alloc": 1600, "ticks": 80, "children": [
+            {"id": 3, "entries": 10, "alloc": 2000, "ticks": 100, "children": []},
+        ]},
+        {"id": 3, "entries": 5, "alloc": 0, "ticks": 0, "children": []},
+    ]},
+}
+
+def test_json(tmp_path):
+    path = tmp_path / "prog.json"
+    path.write_text(json.dumps(JSON_PROFILE, indent=1))
+    with open(str(path)) as f:
+        table = ghcprof.parse_file(f)
+    root = table[0]
+    store = root.store
+    assert store.total_ticks == 200
+    assert store.total_alloc == 4000
+    assert [(depth, name, module, src, entries, time, alloc, inh_time, inh_alloc)
+            for depth, name, module, src, _, entries, time, alloc, inh_time, inh_alloc in tree_rows(root)] == [
+        (0, "MAIN", "MAIN", "<built-in>", 0, 10.0, 10.0, 100.0, 100.0),
+        (1, "main", "Main", "Main.hs:3:1-20", 1, 40.0, 40.0, 90.0, 90.0),
+        (2, "go", "Main", "<no>", 10, 50.0, 50.0, 50.0, 50.0),
+        (1, "go", "Main", "<no>", 5, 0.0, 0.0, 0.0, 0.0),
+    ]
+    # nodes are numbered as JSON profile has no numbers
+    assert len(set(store.no)) == len(store)
@@ -0,0 +1,34 @@
+import math
+
+import pytest
+
+import ghcprof
+
+def reference(store, values):
+    result = []
+    for node in range(len(store)):
+        up = store.parent[node]
+        if up == ghcprof.NO_NODE:
+            result.append(math.nan)
+            continue
+        low, high = sorted([values[node], values[up]])
+        result.append(round(100 * low / high, 2) if high else math.nan)
+    return result
+
+def test_relative(profile_path):
+    with open(profile_path) as f:
+        root = ghcprof.parse_file(f)[0]
+    store = root.store
+    # a child above it's parent, and zeros
+    child = next(iter(root.children))
+    store.inherited_time[child.id] = store.inherited_time[root.id] * 2
+    store.inherited_alloc[root.id] = 0.0
+    store.update_relative()
+    # nodes added later are computed on next use
+    ghcprof.Record.new(store, "new", parent = child, individual_time = 1.0)
+    store.inherited_time[len(store) - 1] = 0.5
+    store.inherited_alloc[len(store) - 1] = 0.0
+    store.update_relative()
+    for values, relative in [(store.inherited_time, store.relative_time),
+                             (store.inherited_alloc, store.relative_alloc)]:
+        assert list(relative) == pytest.approx(reference(store, values), nan_ok=True)